@@ -1,9 +1,16 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import sys
+import time
+import array
 import email.message
 
 from .htmlparser import BlueHTMLParser
+from . import query
+from . import querycache
+from . import search
+from . import store
+from . import textindex
 from . import utils
 
 
@@ -36,54 +43,74 @@ class MailboxAdapter(BaseAdapter):
 
     Extended Adapter that is the bridge between a ListView
     and the metadata of the messages contained in a mailbox file.
+
+    The message headers are kept in a columnar store. Rows are formatted
+    from it on demand and searches run over its columns. The result of a
+    search is the list of the matching message numbers, which grows while
+    the search runs in the background. A search on filtered data refines
+    it, testing only the current matches; the previous results are kept
+    in a stack as arrays, and unfilter() goes back to them one by one.
+    Until the full text index is built, free-text searches skip the
+    blocks of messages ruled out by the block filter of the mailbox.
+    The fts: terms search fts, the full-text index of the mail client
+    (see gloda.GlodaIndex), if given.
+
+    A query can also be previewed as it is typed, see preview().
     """
 
     _mailbox = None
+    _store = None
+    _textindex = None
+    _blocks = None  # Block filter, used until the text index is built
+    _fts = None  # Full-text index of the mail client, if any
+    _results = None  # Cached query results
     _filtereddata = None
+    _search = None
+    _undo = None  # Stack of the previous results
+    _base = None  # Data filtered by the query previewed
+    _previews = None  # (pattern, search) of each preview, None if none
+    _stopping = None  # Searches of replaced previews, not joined yet
 
-    def __init__(self, mailbox):
-        self._data = []
-        self._mailbox = mailbox
-
-        #for n, m in enumerate(mailbox):
-        #    self._data.append(self.__headerline(m, n))
-        for i in range(30):
-            try:
-                msg = mailbox[i]
-            except KeyError:
-                break
-            self._data.append(self.__headerline(msg, i))
+    _months = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+               'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
 
-    def __headerline(self, message, number):
+    def __init__(self, mailbox, fts=None):
+        self._mailbox = mailbox
+        self._fts = fts
+        self._store = store.HeaderStore(mailbox)
+        self._textindex = textindex.TrigramIndex(mailbox)
+        self._blocks = textindex.BlockFilter(mailbox)
+        self._results = querycache.QueryCache(mailbox)
+        self._undo = []
+        self._stopping = []
+
+    def __headerline(self, number):
         """Format message header info into a single text line"""
 
         fields = [None] * 5
         fields[0] = str(number + 1).rjust(2)
         #fields[0] = str(number + 1)
 
-        if message.is_multipart():
+        if self._store.flags[number] & store.FLAG_ATTACHMENT:
             fields[1] = 'a'
         else:
             fields[1] = ' '
 
-        fields[2] = self.__pretty_date(utils.get_header_param(message, 'date'))
-        fields[3] = self.__pretty_from(utils.get_header_param(message, 'from'))
-        fields[4] = utils.get_header_param(message, 'subject').strip()
+        fields[2] = self.__pretty_date(self._store.dates[number],
+                                       self._store.tzoffsets[number])
+        fields[3] = self.__pretty_from(self._store.senders[number])
+        fields[4] = self._store.subjects[number]
 
         return ' '.join(fields)
 
-    def __pretty_date(self, date):
-        """Extract date from the date header string"""
-        # Common format is, e.g: Sat, 16 Jan 2013
-        # Sometetimes the day of the week is not included
-        fields = date.split()
-        if len(fields[0]) > 2:  # Day of week
-            fields = fields[1:]
+    def __pretty_date(self, date, offset):
+        """Format the date in the sender's timezone, e.g: 16 Jan 2013"""
+        if date == store.NODATE:
+            return ' ' * 11
 
-        try:
-            return ('%s %s %s' % (fields[0], fields[1], fields[2])).rjust(11)
-        except TypeError:
-            return date[5:16].rjust(11)  # Best effort
+        tm = time.gmtime(date + offset)
+        return ('%02d %s %d' %
+                (tm.tm_mday, self._months[tm.tm_mon - 1], tm.tm_year)).rjust(11)
 
     def __pretty_from(self, sender):
         """Extract sender from the from header string"""
@@ -109,6 +136,26 @@ class MailboxAdapter(BaseAdapter):
         # Return 15 leading characters left justified
         return sender[:15].ljust(15)
 
+    def save(self):
+        """A.save() -> void
+
+        Keep the headers parsed so far and the search results for the
+        next session. Waits for the searches of replaced previews to
+        stop; see cancel().
+        """
+        self.__join_stopping()
+        self._store.save()
+        self._results.save()
+        if hasattr(self._mailbox, 'save'):
+            self._mailbox.save()  # Header cache, see maildir.Maildir
+
+    def index(self):
+        """A.index() -> void
+
+        Build or update the full text index used by the searches.
+        """
+        self._textindex.update()
+
     def isfiltered(self):
         """A.isfiltered() -> Bool
 
@@ -122,126 +169,185 @@ class MailboxAdapter(BaseAdapter):
     def unfilter(self):
         """A.unfilter() -> void
 
-        Undo a previous search.
+        Undo the last search, going back to the previous results.
+        """
+        self.cancel()
+        self._search = None
+        if self._undo:
+            self._filtereddata = self._undo.pop()
+        else:
+            self._filtereddata = None
+
+    def searching(self):
+        """A.searching() -> Bool
+
+        Return True while a search is running.
+        """
+        return self._search is not None and self._search.isrunning()
+
+    def progress(self):
+        """A.progress() -> float
+
+        Return the fraction of the mailbox searched, from 0 to 1.
+        """
+        if self._search is None:
+            return 1.0
+        return self._search.progress
+
+    def cancel(self):
+        """A.cancel() -> void
+
+        Stop a running search, keeping the messages found so far, and
+        wait for the searches of replaced previews to stop. Call it
+        before the mailbox is closed.
+        """
+        if self._search is not None:
+            self._search.cancel()
+        self.__join_stopping()
+
+    def __join_stopping(self):
+        """Wait for the searches of replaced previews to stop"""
+        for previous in self._stopping:
+            previous.cancel()
+        del self._stopping[:]
+
+    def preview(self, pattern):
+        """A.preview(pattern) -> void
+
+        Filter the data live with a query being typed. Like filterby(),
+        but each call replaces the search of the previous one, dropping
+        its pending work. When the query only gets narrower, the result
+        of the last complete preview is searched instead of the data.
+        End with accept() or reject(). Raise query.QueryError if the
+        query is not valid.
+        """
+        if self._previews is None:
+            self.cancel()
+            self._base, self._previews = self._filtereddata, []
+
+        plan = query.compile(pattern)
+        self._stopping = [previous for previous in self._stopping
+                          if previous.isrunning()]
+        if self._search is not None:
+            self._search.cancel(wait=False)
+            self._stopping.append(self._search)
+
+        numbers = self._base
+        for previous, result in reversed(self._previews):
+            if result.finished and query.narrows(previous, pattern):
+                numbers = result.results
+                break
+
+        self._search = self.__run(plan, numbers)
+        self._filtereddata = self._search.results
+        self._previews.append((pattern, self._search))
+
+    def accept(self, pattern):
+        """A.accept(pattern) -> void
+
+        End the preview, keeping the data filtered with pattern as if
+        by filterby().
+        """
+        if self._previews is None:
+            self.filterby(pattern)
+            return
+
+        if not self._previews or self._previews[-1][0] != pattern:
+            self.preview(pattern)  # Typed too fast to be previewed
+        if self._base is not None:
+            self._undo.append(array.array(store.INTTYPE, self._base))
+        self._base = self._previews = None
+
+    def reject(self):
+        """A.reject() -> void
+
+        End the preview, going back to the data before it.
+        """
+        if self._previews is None:
+            return
+
+        self.cancel()
+        self._search = None
+        self._filtereddata = self._base
+        self._base = self._previews = None
+
+    def __run(self, plan, numbers=None):
+        """Start searching the mailbox, or only numbers, with plan"""
+        if numbers is None:
+            chunks = self._results.run(plan, self._store, self._textindex,
+                                       self._blocks, self._fts)
+            total = len(self._mailbox)
+        else:
+            chunks = query.run(plan, self._mailbox, self._store,
+                               self._textindex, numbers, blocks=self._blocks,
+                               fts=self._fts)
+            total = len(numbers)
+        return search.Search(chunks, total)
+
+    def number(self, row):
+        """A.number(row) -> int
+
+        Return the number in the mailbox of the message shown in row.
         """
-        self._filtereddata = None
+        if self._filtereddata is not None:
+            return self._filtereddata[row]
+        if row < 0:
+            row += len(self)
+        if not 0 <= row < len(self):
+            raise IndexError('list index out of range')
+        return row
 
     def filterby(self, pattern):
         """A.filterby(pattern) -> void
 
-        Filter the data in the adapter with the given pattern. The pattern
-        can be prefixed with a keyword to search specific fields, otherwise
-        the search will be performed in the message fields subject and from
-        and in the main content.
+        Filter the data in the adapter with the given query. Terms search
+        specific fields (from:, subject:, date:, size:, has:attachment),
+        the full-text index of the mail client (fts:) or, without a field,
+        the message fields subject and from and the main content. Terms
+        combine with AND, OR, NOT and parentheses; see the query module.
 
-        Valid keywords are:
+        The old keyword prefixes still work:
         from: Filter messages by their 'from' field.
         subject: Filter messages by their 'subject' field.
         date: Filter messages by their date in dd/mm/yyyy format. If a second
               date is given it will search all messages between the two.
+
+        The search runs in the background: matches are added to the data
+        as they are found, see searching(), progress() and cancel().
+        If the data is already filtered only its messages are searched.
+        Raise query.QueryError if the query is not valid.
         """
-        if self._filtereddata is not None:
+        if not pattern.split():
             return
 
-        p = pattern.lower().split()
-        if p[0] in ('from', 'f') and len(p) > 1:
-            self._filtereddata = self.__filterby_header('from', ' '.join(p[1:]))
-        elif p[0] in ('subject', 's') and len(p) > 1:
-            self._filtereddata = self.__filterby_header('subject', ' '.join(p[1:]))
-        elif p[0] in ('date', 'd') and len(p) > 1:
-            if len(p) > 2:
-                self._filtereddata = self.__filterby_date(p[1], p[2])
-            else:
-                self._filtereddata = self.__filterby_date(p[1])
-        else:
-            self._filtereddata = self.__filter(pattern)
-
-    def __filterby_header(self, param, pattern):
-        data = []
-        for n, m in enumerate(self._mailbox):
-            if pattern in utils.get_header_param(m, param):
-                data.append(self.__headerline(m, n))
-        return data
-
-    def __filter(self, pattern):
-        data = []
-        for n, m in enumerate(self._mailbox):
-            if pattern in utils.get_header_param(m, 'from') or \
-               pattern in utils.get_header_param(m, 'subject') or \
-               pattern in utils.get_content_body(m):
-                    data.append(self.__headerline(m, n))
-        return data
-
-    def __filterby_date(self, date1, date2=None):
-        import datetime
-        data = []
-        #error = False
-        dt1 = dt2 = None
-
-        try:
-            dt1 = datetime.datetime.strptime(date1, '%d/%m/%Y')
-        except ValueError:
-            pass
-            #error = True
-
-        try:
-            dt2 = datetime.datetime.strptime(date2, '%d/%m/%Y')
-        #except ValueError:
-        #    error = True
-        except TypeError:
-            dt2 = datetime.datetime.now()
+        plan = query.compile(pattern)
+        numbers = None
+        if self._filtereddata is not None:
+            self.cancel()  # Refine the matches found so far
+            numbers = array.array(store.INTTYPE, self._filtereddata)
+            self._undo.append(numbers)
 
-        if dt2 > dt1:
-            dt1, dt2 = dt2, dt1
-
-        for n, m in enumerate(self._mailbox):
-            date = utils.get_header_param(m, 'date')[5:16]
-            try:
-                dt = datetime.datetime.strptime(date, '%d %b %Y')
-            except ValueError:
-                continue
-            if dt > dt1:
-                continue
-            elif dt < dt2:
-                break
-            else:
-                data.append(self.__headerline(m, n))
-        return data
+        self._search = self.__run(plan, numbers)
+        self._filtereddata = self._search.results
 
     def __len__(self):
         if self._filtereddata is None:
-            #return len(self._data)
             return len(self._mailbox)
         else:
             return len(self._filtereddata)
 
     def __getitem__(self, key):
         """x.__getitem__(y) <==> x[y]"""
-        # Delegate checks to list implementation
-        if self._filtereddata is not None:
-            return self._filtereddata[key]
-        else:
-            #return self._data[key]
-            try:
-                return self._data[key]
-            except IndexError:
-                pass  # Fetch more data from mailbox
-
-            len_ = len(self._data)
-            for i in range(len_, len_ + 10):
-                try:
-                    msg = self._mailbox[i]
-                except KeyError:
-                    break
-                self._data.append(self.__headerline(msg, i))
-            return self._data[key]
+        number = self.number(key)
+
+        # Fetch the page of the row from the mailbox
+        self._store.load(number, number + 1)
+        return self.__headerline(number)
 
     def __iter__(self):
         """x.__iter__() <==> iter(x)"""
-        if self._filtereddata is None:
-            return iter(self._data)
-        else:
-            return iter(self._filtereddata)
+        for i in range(len(self)):
+            yield self[i]
 
 
 class MessageAdapter(BaseAdapter):
@@ -248,9 +248,10 @@ class InboxActivity(Activity):
 
     _mailreader = None
     _commonfoottext = 'Q:Quit M:Mailboxes P:Profiles'
-    _searchfoottext = ' /:Search'
-    _undofoottext = ' U:Undo search'
-    _listviewpos = None
+    _searchfoottext = ' /:Search I:Index'
+    _undofoottext = ' /:Refine U:Undo search'
+    _listviewpos = None  # Stack of the list positions before each search
+    _searching = False  # A search runs in the background
 
     def __init__(self, screen=None):
         super(InboxActivity, self).__init__(screen)
@@ -308,12 +309,56 @@ class InboxActivity(Activity):
                                  ('/'.join(self.mailreader
                                                .mbpath.split('/')[-2:])),
                                  len(self.mailreader),
-                                 (os.path.getsize(self.mailreader
-                                                      .mbpath)/(1024*1024.0))))
+                                 (getattr(self.mailreader.mailbox, 'size', 0) /
+                                  (1024*1024.0))))
 
         self._footer.text = self._commonfoottext + self._searchfoottext
-        self._listview.adapter = adapter.MailboxAdapter(self._mailreader
-                                                            .mailbox)
+        self._listview.adapter = adapter.MailboxAdapter(
+            self._mailreader.mailbox, getattr(self._mailreader, 'gloda', None))
+        self._listviewpos = []
+
+    def onPause(self):
+        # Also called before quitting or opening another mailbox: no
+        # search, previews included, may outlive it
+        self._listview.adapter.cancel()
+        if self._searching:
+            self._updatesearch()
+        self._listview.adapter.save()
+
+    def _updatesearch(self):
+        """Show the progress of the running search, or its end"""
+        adapter_ = self._listview.adapter
+        if adapter_.searching():
+            self._footer.text = ('Searching... %d%% (%d found) ESC:Cancel' %
+                                 (100 * adapter_.progress(), len(adapter_)))
+        else:
+            self._searching = False
+            self.screen.timeout(-1)  # Back to blocking reads
+            self._footer.text = self._commonfoottext + self._undofoottext
+
+    def _preview(self, text):
+        """Filter the list with the query being typed"""
+        if not text.split():
+            self._listview.adapter.reject()
+            return
+
+        try:
+            self._listview.adapter.preview(text)
+        except ValueError:
+            return  # Incomplete query: keep the last results
+        self._rewind()
+
+    def _rewind(self):
+        """Show the list from its first row"""
+        self._listview.pos = self._listview.top = 0
+        self._listview.bottom = self.maxy - 2
+
+    def _refresh(self):
+        """Redraw the list and the footer only, without flicker"""
+        for view in (self._listview, self._footer):
+            view.draw()
+            view.window.noutrefresh()
+        curses.doupdate()
 
     def onResume(self, bundle=None):
         if bundle is None:
@@ -333,19 +378,31 @@ class InboxActivity(Activity):
                 self.onCreate()
 
     def onKey(self, ch):
+        if self._searching:
+            # Results stream in: getch() times out to show them
+            if ch == 27:  # ESC: keep the messages found so far
+                self._listview.adapter.cancel()
+            self._updatesearch()
+            if ch in (-1, 27):
+                self._refresh()
+                return True
+
         for view in self._views:
             if view is not None and view.onKey(ch):
                 self.draw()
                 return True
 
         if ch in (10, ord('e'), ord('E')):  # Enter
-            #msgnum = int(self._listview.adapter[self._listview.pos]
-            #                           .split()[0]) - 1
-            #self._startActivity(MessageActivity(),
-            #                    {'message':self.mailreader[msgnum]})
-            self._startActivity(MessageActivity(),
-                                {'message':
-                                 self.mailreader[self._listview.pos]})
+            if len(self._listview.adapter) == 0:
+                curses.flash()
+                return True
+            msgnum = self._listview.adapter.number(self._listview.pos)
+            try:
+                message = self.mailreader[msgnum]
+            except KeyError:
+                curses.flash()  # Removed since the mailbox was opened
+                return True
+            self._startActivity(MessageActivity(), {'message': message})
             return True
         if ch in [ord('m'), ord('M')]:
             self._startActivity(MailboxListActivity(),
@@ -355,35 +412,59 @@ class InboxActivity(Activity):
             self._startActivity(ProfileListActivity(),
                                 {'mailreader': self.mailreader})
             return True
-        elif ch in [ord('/')]:  # Search
-            if self._listview.adapter.isfiltered():
-                curses.flash()
+        elif ch in [ord('/')]:  # Search as you type, or refine the results
+            pos = self._listview.pos
+            tmp = self._footer.edit(onchange=self._preview,
+                                    onidle=self._refresh)
+            try:
+                if tmp is None or not tmp.split():
+                    raise ValueError
+                self._listview.adapter.accept(tmp)
+            except ValueError as e:  # Cancelled, or invalid query
+                self._listview.adapter.reject()
+                self._listview._move(pos)
+                self.draw()
+                if str(e):
+                    self._footer.error(str(e), curses.A_REVERSE)
                 return True
 
-            tmp = self._footer.edit()
-            if tmp is None:
-                self.draw()
+            self._listviewpos.append(pos)
+            self._rewind()
+            self._searching = True
+            self.screen.timeout(200)  # ms between updates
+            self._updatesearch()
+
+            self.draw()
+            return True
+        elif ch in [ord('i'), ord('I')]:  # Build search index
+            if self._searching:
+                curses.flash()
                 return True
 
-            self._footer.text = 'Searching... This could take a few minutes.'
+            self._footer.text = 'Indexing... This could take a few minutes.'
             self._footer.draw()
             self._footer.window.refresh()
 
-            self._listviewpos = self._listview.pos
-            self._listview.adapter.filterby(tmp)
+            self._listview.adapter.index()
 
             if self._listview.adapter.isfiltered():
                 self._footer.text = self._commonfoottext + self._undofoottext
-                self._listview._move(0)
-
+            else:
+                self._footer.text = (self._commonfoottext +
+                                     self._searchfoottext)
             self.draw()
             return True
         elif ch in [ord('u'), ord('U')]:
             self._listview.adapter.unfilter()
-            if self._listviewpos is not None:
-                self._listview._move(self._listviewpos)
-                self._listviewpos = None
-            self._footer.text = self._commonfoottext + self._searchfoottext
+            if self._searching:
+                self._updatesearch()
+            if self._listviewpos:
+                self._listview._move(self._listviewpos.pop())
+            if self._listview.adapter.isfiltered():
+                self._footer.text = self._commonfoottext + self._undofoottext
+            else:
+                self._footer.text = (self._commonfoottext +
+                                     self._searchfoottext)
             self.draw()
         else:
             return super(InboxActivity, self).onKey(ch)
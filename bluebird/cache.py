@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Bluebird cache directory
+
+Bluebird never writes inside the Thunderbird profile. Any data derived
+from the profile (mailbox indexes and the like) is stored as a sidecar
+file in a private cache directory instead.
+
+functions:
+
+sidecar_path -- Path of the cache file derived from a profile file
+load -- Read a cache file, None if missing or unreadable
+dump -- Atomically write a cache file
+
+"""
+import os
+import os.path
+import hashlib
+import pickle
+
+### Module Constants ##
+
+CACHEPATH = (os.getenv('XDG_CACHE_HOME') or
+             os.path.join(os.getenv('HOME') or '/tmp', '.cache'))
+CACHEPATH = os.path.join(CACHEPATH, 'bluebird')
+
+
+# =================================================================
+
+
+def sidecar_path(path, suffix):
+    """Return the cache file path for the file in path
+
+    The name is made from the file basename and a digest of its full
+    path, so files with the same name in different folders (every
+    account has its own INBOX) do not collide.
+
+    """
+    path = os.path.abspath(path)
+    digest = hashlib.sha1(path.encode('utf-8')).hexdigest()[:16]
+    name = '%s-%s.%s' % (os.path.basename(path), digest, suffix)
+    return os.path.join(CACHEPATH, name)
+
+
+def load(path):
+    """Return the object stored in path or None if it can not be read"""
+    try:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    except Exception:
+        # Missing, truncated or written by an incompatible version.
+        # Cache files are disposable: treat them as missing.
+        return None
+
+
+def dump(path, obj):
+    """Store obj in path
+
+    The data is written to a temporary file that is then renamed over
+    path, so readers never see a partially written file. Errors are
+    ignored: a cache that can not be written is simply not used.
+
+    """
+    tmppath = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(tmppath, 'wb') as f:
+            pickle.dump(obj, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmppath, path)
+    except (IOError, OSError):
+        try:
+            os.remove(tmppath)
+        except OSError:
+            pass
@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Mailbox discovery
+
+Finding the mailboxes of a profile lists every mail directory and
+probes each of its files, tens of thousands of system calls on profiles
+with thousands of folders.
+
+The result of each directory is cached with its modification time. A
+directory whose time is unchanged is not listed again: its mailboxes
+and subdirectories come from the cache, at the cost of one stat. Only
+the directories that changed are listed, with os.scandir, which tells
+files from directories without a stat of each entry, and only their
+files are probed.
+
+Only the folder hierarchy of Thunderbird is followed: the subfolders
+of the folder in file name are in directory name.sbd, and the other
+directories are left out, except maildir folders (see maildir.Maildir).
+
+Writing to a file does not change the time of its directory, and a
+new folder is an empty file until mail arrives: the empty files are
+probed again on every scan.
+
+classes:
+
+FolderCache -- Persistent cache of the mailboxes of mail directories
+
+functions:
+
+is_mbox -- Test whether a file is an mbox file by its name and start
+
+"""
+import os
+import os.path
+
+try:
+    from os import scandir
+except ImportError:
+    scandir = None  # Python 2: os.listdir and a stat of each entry
+
+from . import cache
+from . import maildir
+
+### Module Constants ##
+
+# Bump when the layout of the cache changes
+CACHEVERSION = 1
+
+
+# =================================================================
+
+
+class FolderCache(object):
+    """Persistent cache of the mailboxes of mail directories
+
+    Each directory scanned is remembered as its modification time, the
+    names of its mailboxes, of its empty files and of its
+    subdirectories. The cache is kept for the profile in path.
+
+    """
+
+    _path = None  # Cache file
+    _dirs = None  # directory -> (mtime, mailboxes, empty, subdirectories)
+    _seen = None  # Directories scanned, the others are dropped on save
+    _dirty = False
+
+    def __init__(self, path):
+        self._path = cache.sidecar_path(path, 'dir')
+        self._seen = set()
+
+        data = cache.load(self._path)
+        if data is not None and data['version'] == CACHEVERSION:
+            self._dirs = data['dirs']
+        else:
+            self._dirs = {}
+
+    def scan(self, directory):
+        """F.scan(directory) -> list
+
+        Return the paths of the mailboxes in directory and, depth first,
+        in its subfolder directories.
+        """
+        mailboxes = []
+        pending = [directory]
+        while pending:
+            path = pending.pop()
+            names, subdirs = self._scan_dir(path)
+            mailboxes.extend(os.path.join(path, name) for name in names)
+            pending.extend(os.path.join(path, name)
+                           for name in reversed(subdirs))
+        return mailboxes
+
+    def save(self):
+        """F.save() -> void
+
+        Store the directories scanned for the next session.
+        """
+        if not self._dirty and len(self._seen) == len(self._dirs):
+            return
+
+        dirs = dict((path, entry) for path, entry in self._dirs.items()
+                    if path in self._seen)
+        cache.dump(self._path, {'version': CACHEVERSION, 'dirs': dirs})
+        self._dirty = False
+
+    def _scan_dir(self, path):
+        """Mailboxes and subdirectories of directory path"""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return [], []
+        mtime = getattr(st, 'st_mtime_ns', st.st_mtime)
+        self._seen.add(path)
+
+        entry = self._dirs.get(path)
+        if entry is not None and entry[0] == mtime:
+            mailboxes, empty, subdirs = entry[1:]
+            filled = [name for name in empty
+                      if is_mbox(os.path.join(path, name))]
+            if filled:
+                # Mail arrived in a new folder
+                mailboxes = sorted(mailboxes + filled)
+                empty = [name for name in empty if name not in filled]
+                self._dirs[path] = (mtime, mailboxes, empty, subdirs)
+                self._dirty = True
+            return mailboxes, subdirs
+
+        mailboxes, empty, subdirs = [], [], []
+        try:
+            files, subdirs = _list(path)
+        except OSError:
+            return [], []
+        for name in subdirs:
+            if maildir.is_maildir(os.path.join(path, name)):
+                mailboxes.append(name)
+        subdirs = [name for name in subdirs if name.endswith('.sbd')]
+        for name in files:
+            filename = os.path.join(path, name)
+            if is_mbox(filename):
+                mailboxes.append(name)
+            elif '.' not in name and _isempty(filename):
+                empty.append(name)
+        mailboxes.sort()
+
+        self._dirs[path] = (mtime, mailboxes, empty, subdirs)
+        self._dirty = True
+        return mailboxes, subdirs
+
+
+# =================================================================
+
+
+def is_mbox(path):
+    """is_mbox(path) -> Bool
+
+    Return True if the file in path is an mbox file: its name has no
+    dot (summaries and the like have one) and it starts with a From
+    line. False otherwise, or if it can not be read.
+    """
+    if '.' in os.path.basename(path):
+        return False
+
+    try:
+        with open(path, 'rb') as f:
+            return f.read(5) == b'From '
+    except (IOError, OSError):
+        return False  # Vanished or unreadable
+
+
+def _list(path):
+    """Sorted names of the files and subdirectories in directory path"""
+    files, dirs = [], []
+    if scandir is not None:
+        for entry in scandir(path):
+            (dirs if entry.is_dir() else files).append(entry.name)
+    else:
+        for name in os.listdir(path):
+            if os.path.isdir(os.path.join(path, name)):
+                dirs.append(name)
+            else:
+                files.append(name)
+    return sorted(files), sorted(dirs)
+
+
+def _isempty(path):
+    """Return True if the file in path is empty"""
+    try:
+        return os.path.getsize(path) == 0
+    except OSError:
+        return False
+
+
+# =================================================================
+# Testing procedures.
+# Execute this module (python -m bluebird.folders) to perform unit testing.
+# =================================================================
+
+if __name__ == '__main__':
+    import shutil
+    import tempfile
+    import unittest
+
+    class TestFolderCache(unittest.TestCase):
+
+        def setUp(self):
+            cache.CACHEPATH = tempfile.mkdtemp()
+            self._root = tempfile.mkdtemp()
+            self.write('INBOX', 'From a\n\nHi\n')
+            self.write('INBOX.msf', 'From a\n')
+            self.write('Sent', '')
+            os.mkdir(os.path.join(self._root, 'Work.sbd'))
+            os.mkdir(os.path.join(self._root, 'filters'))
+            self.write('filters/Old', 'From x\n\nNot a folder\n')
+            self.write('Work.sbd/Invoices', 'From b\n\nPay\n')
+
+            # Count the files probed
+            global is_mbox
+            self._is_mbox, self.probed = is_mbox, []
+
+            def probe(path):
+                self.probed.append(os.path.relpath(path, self._root))
+                return self._is_mbox(path)
+            is_mbox = probe
+
+        def tearDown(self):
+            global is_mbox
+            is_mbox = self._is_mbox
+            shutil.rmtree(cache.CACHEPATH)
+            shutil.rmtree(self._root)
+
+        def write(self, name, text):
+            with open(os.path.join(self._root, name), 'w') as f:
+                f.write(text)
+
+        def scan(self):
+            folders = FolderCache(self._root)
+            self.probed = []
+            found = [os.path.relpath(path, self._root)
+                     for path in folders.scan(self._root)]
+            folders.save()
+            return found
+
+        def test_scan(self):
+            self.assertEqual(self.scan(), ['INBOX', 'Work.sbd/Invoices'])
+            self.assertEqual(len(self.probed), 4)
+
+            # Unchanged: only the empty folder is probed again
+            self.assertEqual(self.scan(), ['INBOX', 'Work.sbd/Invoices'])
+            self.assertEqual(self.probed, ['Sent'])
+
+            self.write('Sent', 'From c\n\nSent\n')
+            self.assertEqual(self.scan(),
+                             ['INBOX', 'Sent', 'Work.sbd/Invoices'])
+            self.assertEqual(self.scan(),
+                             ['INBOX', 'Sent', 'Work.sbd/Invoices'])
+            self.assertEqual(self.probed, [])
+
+            # Changed directory: listed again
+            self.write('Work.sbd/Expenses', 'From d\n\nPaid\n')
+            self.assertEqual(self.scan(), ['INBOX', 'Sent',
+                                           'Work.sbd/Expenses',
+                                           'Work.sbd/Invoices'])
+            self.assertEqual(self.probed, ['Work.sbd/Expenses',
+                                           'Work.sbd/Invoices'])
+
+        def test_maildir(self):
+            os.makedirs(os.path.join(self._root, 'Drafts', 'cur'))
+            os.makedirs(os.path.join(self._root, 'Drafts.sbd', 'Old', 'cur'))
+            self.assertEqual(self.scan(), ['Drafts', 'INBOX',
+                                           'Drafts.sbd/Old',
+                                           'Work.sbd/Invoices'])
+
+        def test_missing(self):
+            folders = FolderCache(self._root)
+            self.assertEqual(folders.scan(os.path.join(self._root, 'x')), [])
+
+    unittest.main()
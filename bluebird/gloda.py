@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Thunderbird global search database
+
+Thunderbird indexes the mail of a profile in global-messages-db.sqlite
+(Gloda): a messages table with the folder and message key of each
+message, and messagesText, an SQLite full-text table of their body,
+attachment names, author, recipients and subject. Searching it costs a
+query instead of a read of the mailbox.
+
+Folders are matched by their URI: mailbox://nobody@Local%20Folders/a/b
+is the mbox file a.sbd/b in the 'Local Folders' mail directory. A
+message key is the key of the message in the folder summary (see
+mork.Summary); only folders with a summary that matches their mbox file
+can be searched. A query searches one folder (GlodaIndex.search) or all
+the folders of the profile at once (GlodaIndex.search_folders).
+
+Thunderbird builds messagesText with its own tokenizer, unknown to
+other SQLite programs. When the full-text match is not available, the
+text the table stores is searched for every word of the pattern instead,
+ignoring case.
+
+The database is only read, never written.
+
+classes:
+
+GlodaIndex -- Read only access to the Gloda database of a profile
+
+"""
+import os
+import os.path
+import sqlite3
+import contextlib
+
+try:
+    from urllib.parse import quote, unquote, urlsplit
+except ImportError:
+    from urllib import quote, unquote  # Python 2
+    from urlparse import urlsplit
+
+### Module Constants ##
+
+GLODAFILE = 'global-messages-db.sqlite'
+
+# Folder states (folderLocations.dirtyStatus, indexingPriority) that
+# leave the index unreliable
+DIRTY_FILTHY = 2
+PRIORITY_NEVER = -1
+
+
+# =================================================================
+
+
+class GlodaIndex(object):
+    """Read only access to the Gloda database of a profile"""
+
+    _path = None
+    _folders = None  # (directory, folder) -> folder id, None until read
+
+    def __init__(self, path):
+        self._path = path
+
+    def search(self, mailbox, pattern):
+        """G.search(mailbox, pattern) -> list or None
+
+        Return the ascending numbers of the messages of mailbox (see
+        mbox.Mbox) that Gloda finds with pattern, a full-text query.
+        None if Gloda does not cover the mailbox, or if it finds a
+        message its summary does not list.
+        """
+        try:
+            folder = self._folder(mailbox.path)
+        except AttributeError:
+            return None
+        summary = getattr(mailbox, 'summary', None)
+        if folder is None or not summary:
+            return None  # No way to tell the messages of the keys
+
+        try:
+            keys = set(key for folder, key in self._search([folder], pattern))
+        except sqlite3.Error:
+            return None
+
+        return _numbers(summary, keys)
+
+    def search_folders(self, paths, pattern, open_mailbox):
+        """G.search_folders(paths, pattern, open_mailbox) -> (list, list)
+
+        Search the folders of the mailboxes in paths at once. Return the
+        (path, number) of the messages Gloda finds with pattern, sorted,
+        and the paths of the folders it can not answer for, to be
+        searched otherwise: those it does not cover, and those with hits
+        their summary does not map. open_mailbox(path) opens the
+        mailbox of a folder with hits (see mbox.Mbox), only to read its
+        summary; it is closed after.
+        """
+        paths = list(paths)
+        folders = {}  # Folder id -> path
+        unsearched = set()
+        for path in paths:
+            folder = self._folder(path)
+            if folder is None:
+                unsearched.add(path)
+            else:
+                folders[folder] = path
+
+        found = {}  # Folder id -> keys
+        try:
+            if folders:
+                for folder, key in self._search(sorted(folders), pattern):
+                    found.setdefault(folder, set()).add(key)
+        except sqlite3.Error:
+            return [], paths
+
+        hits = []
+        for folder, keys in found.items():
+            path = folders[folder]
+            mailbox = open_mailbox(path)
+            try:
+                numbers = _numbers(getattr(mailbox, 'summary', None), keys)
+            finally:
+                if hasattr(mailbox, 'close'):
+                    mailbox.close()
+            if numbers is None:
+                unsearched.add(path)
+            else:
+                hits.extend((path, n) for n in numbers)
+
+        hits.sort()
+        return hits, [path for path in paths if path in unsearched]
+
+    def _folder(self, path):
+        """Gloda id of the folder of mbox file path, None if the folder is
+        not indexed"""
+        if self._folders is None:
+            self._folders = {}
+            try:
+                with contextlib.closing(self._connect()) as db:
+                    for rowid, uri, dirty, priority in db.execute(
+                            'SELECT id, folderURI, dirtyStatus, '
+                            'indexingPriority FROM folderLocations'):
+                        if (dirty != DIRTY_FILTHY and
+                                priority != PRIORITY_NEVER):
+                            self._folders[_uri_folder(uri)] = rowid
+            except sqlite3.Error:
+                pass  # No usable database: nothing is covered
+
+        return self._folders.get(_path_folder(path))
+
+    def _search(self, folders, pattern):
+        """(folder id, message key) of the messages of folders matching
+        pattern"""
+        infolders = 'm.folderID IN (%s)' % ', '.join('?' * len(folders))
+        with contextlib.closing(self._connect()) as db:
+            try:
+                return db.execute(
+                    'SELECT m.folderID, m.messageKey FROM messagesText t '
+                    'JOIN messages m ON m.id = t.docid '
+                    'WHERE messagesText MATCH ? AND ' + infolders +
+                    ' AND m.deleted = 0', [pattern] + folders).fetchall()
+            except sqlite3.OperationalError:
+                pass  # Thunderbird's tokenizer is missing
+
+            words = pattern.split()
+            if not words:
+                return []
+            where = ' AND '.join(["(c.c0body LIKE ? ESCAPE '\\' OR "
+                                  "c.c2author LIKE ? ESCAPE '\\' OR "
+                                  "c.c4subject LIKE ? ESCAPE '\\')"] *
+                                 len(words))
+            args = []
+            for word in words:
+                word = (word.replace('\\', '\\\\').replace('%', '\\%')
+                        .replace('_', '\\_'))
+                args.extend(['%' + word + '%'] * 3)
+            return db.execute(
+                'SELECT m.folderID, m.messageKey FROM messagesText_content c '
+                'JOIN messages m ON m.id = c.docid '
+                'WHERE ' + infolders + ' AND m.deleted = 0 AND ' + where,
+                folders + args).fetchall()
+
+    def _connect(self):
+        """Open the database read only"""
+        if not os.path.exists(self._path):
+            raise sqlite3.OperationalError('No database ' + self._path)
+        try:
+            return sqlite3.connect('file:%s?mode=ro' % quote(self._path),
+                                   uri=True)
+        except TypeError:
+            return sqlite3.connect(self._path)  # Python 2: no URIs
+
+
+# =================================================================
+
+
+def _numbers(summary, keys):
+    """Ascending numbers of the messages with keys in summary (see
+    mbox.Mbox.summary), None if it does not list them all"""
+    if not summary:
+        return None  # No way to tell the messages of the keys
+
+    numbers = dict((entry[6], n) for n, entry in summary.items())
+    try:
+        return sorted(numbers[key] for key in keys)
+    except KeyError:
+        return None  # Summary and index out of step
+
+
+def _uri_folder(uri):
+    """(directory, folder) of a folder URI"""
+    parts = urlsplit(uri)
+    host = unquote(parts.netloc.rpartition('@')[2])
+    return host, unquote(parts.path.strip('/'))
+
+
+def _path_folder(path):
+    """(directory, folder) of an mbox file path: the subfolders of a
+    folder are in its .sbd directory"""
+    parts = os.path.abspath(path).split(os.sep)
+    names = [parts.pop()]
+    while parts and parts[-1].endswith('.sbd'):
+        names.insert(0, parts.pop()[:-len('.sbd')])
+    return parts[-1] if parts else '', '/'.join(names)
+
+
+# =================================================================
+# Testing procedures.
+# Execute this module (python -m bluebird.gloda) to perform unit testing.
+# =================================================================
+
+if __name__ == '__main__':
+    import shutil
+    import tempfile
+    import unittest
+
+    SCHEMA = ('CREATE TABLE folderLocations (id INTEGER PRIMARY KEY, '
+              'folderURI TEXT, dirtyStatus INTEGER, name TEXT, '
+              'indexingPriority INTEGER)',
+              'CREATE TABLE messages (id INTEGER PRIMARY KEY, '
+              'folderID INTEGER, messageKey INTEGER, '
+              'deleted INTEGER NOT NULL DEFAULT 0)')
+
+    class Mailbox(list):
+        """Mailbox with the attributes of mbox.Mbox"""
+
+        path = None
+        summary = {0: (0, 100, None, 0, '', '', 0),
+                   1: (100, 100, None, 0, '', '', 1),
+                   2: (200, 100, None, 0, '', '', 7)}
+
+    class TestGlodaIndex(unittest.TestCase):
+
+        def setUp(self):
+            self._dir = tempfile.mkdtemp()
+            self._path = os.path.join(self._dir, GLODAFILE)
+            self._mailbox = Mailbox()
+            self._mailbox.path = os.path.join(self._dir, 'Local Folders',
+                                              'Work.sbd', 'Invoices')
+
+        def tearDown(self):
+            shutil.rmtree(self._dir)
+
+        def create(self, table, insert):
+            db = sqlite3.connect(self._path)
+            for statement in SCHEMA + (table,):
+                db.execute(statement)
+            db.executemany(
+                'INSERT INTO folderLocations VALUES (?, ?, ?, ?, ?)',
+                [(1, 'mailbox://nobody@Local%20Folders/Work/Invoices', 1,
+                  'Invoices', 50),
+                 (2, 'mailbox://nobody@Local%20Folders/Trash', 0,
+                  'Trash', PRIORITY_NEVER)])
+            db.executemany('INSERT INTO messages VALUES (?, ?, ?, ?)',
+                           [(10, 1, 0, 0), (11, 1, 100, 1), (12, 1, 7, 0),
+                            (13, 2, 0, 0)])
+            for docid, body in ((10, 'Please pay the invoice'),
+                                (11, 'Deleted invoice'),
+                                (12, 'Another INVOICE to pay'),
+                                (13, 'Trash invoice')):
+                db.execute(insert, (docid, body))
+            db.commit()
+            db.close()
+
+        def test_match(self):
+            self.create('CREATE VIRTUAL TABLE messagesText USING '
+                        'fts3(body, attachmentNames, author, recipients, '
+                        'subject)',
+                        'INSERT INTO messagesText (docid, body, author, '
+                        'subject) VALUES (?, ?, \'\', \'\')')
+            index = GlodaIndex(self._path)
+            self.assertEqual(index.search(self._mailbox, 'invoice'), [0, 2])
+            self.assertEqual(index.search(self._mailbox, 'another'), [2])
+
+            self._mailbox.path = os.path.join(self._dir, 'Local Folders',
+                                              'Trash')
+            self.assertIsNone(index.search(self._mailbox, 'invoice'))
+
+        def test_content(self):
+            # Without Thunderbird's tokenizer: the stored text is searched
+            self.create('CREATE TABLE messagesText_content (docid INTEGER, '
+                        'c0body TEXT, c1attachmentNames TEXT, '
+                        'c2author TEXT, c3recipients TEXT, c4subject TEXT)',
+                        'INSERT INTO messagesText_content (docid, c0body, '
+                        'c2author, c4subject) VALUES (?, ?, \'\', \'\')')
+            index = GlodaIndex(self._path)
+            self.assertEqual(index.search(self._mailbox, 'pay invoice'),
+                             [0, 2])
+            self.assertEqual(index.search(self._mailbox, '100%'), [])
+
+            # Keys the summary does not map: scanned instead
+            self._mailbox.summary = dict(self._mailbox.summary)
+            del self._mailbox.summary[2]
+            self.assertIsNone(index.search(self._mailbox, 'another'))
+            self._mailbox.summary = None
+            self.assertIsNone(index.search(self._mailbox, 'please'))
+
+        def test_folders(self):
+            self.create('CREATE VIRTUAL TABLE messagesText USING '
+                        'fts3(body, attachmentNames, author, recipients, '
+                        'subject)',
+                        'INSERT INTO messagesText (docid, body, author, '
+                        'subject) VALUES (?, ?, \'\', \'\')')
+            index = GlodaIndex(self._path)
+            trash = os.path.join(self._dir, 'Local Folders', 'Trash')
+            other = os.path.join(self._dir, 'Local Folders', 'Other')
+            paths = [trash, self._mailbox.path, other]
+            opened = []
+
+            def open_mailbox(path):
+                opened.append(path)
+                return self._mailbox
+
+            self.assertEqual(index.search_folders(paths, 'invoice',
+                                                  open_mailbox),
+                             ([(self._mailbox.path, 0),
+                               (self._mailbox.path, 2)], [trash, other]))
+            self.assertEqual(opened, [self._mailbox.path])
+
+            # No hit: no mailbox opened
+            del opened[:]
+            self.assertEqual(index.search_folders(paths, 'nothing',
+                                                  open_mailbox),
+                             ([], [trash, other]))
+            self.assertEqual(opened, [])
+
+            self._mailbox.summary = None
+            self.assertEqual(index.search_folders(paths, 'invoice',
+                                                  open_mailbox),
+                             ([], paths))
+
+        def test_missing(self):
+            index = GlodaIndex(self._path)
+            self.assertIsNone(index.search(self._mailbox, 'invoice'))
+            self.assertIsNone(index.search([], 'invoice'))
+            self.assertEqual(index.search_folders([self._mailbox.path],
+                                                  'invoice', list),
+                             ([], [self._mailbox.path]))
+
+    unittest.main()
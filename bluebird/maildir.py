@@ -0,0 +1,460 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""maildir mailbox reader
+
+Read only reader of the maildir folders of Thunderbird, with the
+interface of mbox.Mbox. A folder is a directory with one file per
+message in its cur and new subdirectories, and its subfolders in the
+directory folder.sbd beside it, as with mbox files.
+
+Messages are numbered in the order of their file names, which start
+with their delivery time. Opening a folder only lists these two
+directories, with os.scandir; a message is read by opening its file,
+there is no table of contents to build.
+
+The main headers of every message read (see CACHEDHEADERS) and its
+size are cached in a sidecar file, keyed by the unique part of its file
+name, which never changes: a folder opened again is not read at all to
+load its headers. Headers missing from the cache are read by a pool of
+threads, see Maildir.read_headers. The cache is stored by save() and
+close().
+
+The key of a message (see mbox.Mbox) is a digest of the unique part of
+its file name.
+
+classes:
+
+Maildir -- maildir folder reader with a persistent header cache
+
+functions:
+
+is_maildir -- Test whether a directory is a maildir folder
+
+"""
+import os
+import os.path
+import re
+import sys
+import array
+import hashlib
+import struct
+import mailbox
+import threading
+import email.parser
+import multiprocessing.pool
+
+try:
+    from os import scandir
+except ImportError:
+    scandir = None  # Python 2: os.listdir and a stat of each entry
+
+from . import cache
+from . import mbox
+
+### Module Constants ##
+
+# Bump when the layout of the header cache changes
+CACHEVERSION = 1
+
+# Headers kept in the cache: those the header store and views use
+CACHEDHEADERS = ('Date', 'From', 'To', 'Cc', 'Subject', 'Message-ID',
+                 'Content-Type')
+
+READTHREADS = 8  # Files read at the same time by read_headers()
+
+_SUBDIRS = ('cur', 'new')
+
+_CACHED = re.compile(br'^(?:' +
+                     br'|'.join(h.encode('ascii') for h in CACHEDHEADERS) +
+                     br'):.*\n(?:[ \t].*\n)*', re.M | re.I)
+
+if sys.version_info.major == 3:
+    _HEADERPARSER = email.parser.BytesHeaderParser().parsebytes
+else:
+    _HEADERPARSER = email.parser.HeaderParser().parsestr
+
+
+# =================================================================
+
+
+class Maildir(object):
+    """Read only maildir folder
+
+    Supports len(), indexing by message number (KeyError if there is no
+    such message) and iteration like mbox.Mbox. Messages are returned as
+    mailbox.MaildirMessage objects.
+
+    The list of messages never changes after opening: messages delivered
+    later are not seen until the folder is opened again, and reading a
+    message removed since raises KeyError. Any number of threads may
+    read messages at the same time; the header cache is locked.
+
+    """
+
+    _path = None
+    _files = None  # Message file paths, relative to the folder
+    _keys = None  # Message keys
+    _cachepath = None
+    _headers = None  # unique name -> (size, cached headers)
+    _dirty = False
+    _lock = None  # Guards _headers and _dirty
+
+    def __init__(self, path):
+        self._path = path
+        self._cachepath = cache.sidecar_path(path, 'mdh')
+        self._lock = threading.Lock()
+
+        files = []
+        for subdir in _SUBDIRS:
+            try:
+                files.extend((_unique(name), subdir + '/' + name)
+                             for name in _list(os.path.join(path, subdir)))
+            except OSError:
+                pass  # No such subdirectory
+        files.sort()
+
+        self._files = [name for unique, name in files]
+        self._keys = array.array(mbox.TOCTYPE,
+                                 [_key(unique) for unique, name in files])
+
+    def __len__(self):
+        return len(self._files)
+
+    def __getitem__(self, key):
+        return self.get_message(key)
+
+    def __iter__(self):
+        for key in range(len(self)):
+            yield self.get_message(key)
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def keys(self):
+        """Array with the key of every message"""
+        return self._keys
+
+    @property
+    def size(self):
+        """Total size in bytes of the messages whose headers are cached;
+        no message file is read, those not read yet count for nothing"""
+        self._load()
+        with self._lock:
+            return sum(self._headers[_unique(name)][0]
+                       for name in self._files
+                       if _unique(name) in self._headers)
+
+    def close(self):
+        """Store the headers read for the next session"""
+        self.save()
+
+    def save(self):
+        """M.save() -> void
+
+        Store the headers read so far for the next session, if any new
+        were read.
+        """
+        with self._lock:
+            if not self._dirty:
+                return
+            uniques = set(_unique(name) for name in self._files)
+            headers = dict((unique, entry)
+                           for unique, entry in self._headers.items()
+                           if unique in uniques)
+            self._dirty = False
+
+        cache.dump(self._cachepath, {'version': CACHEVERSION,
+                                     'headers': headers})
+
+    def get_bytes(self, key):
+        """M.get_bytes(key) -> bytes
+
+        Return the raw message, the whole file.
+        """
+        try:
+            with open(self._lookup(key), 'rb') as f:
+                return f.read()
+        except (IOError, OSError):
+            raise KeyError('No message with key: %s' % key)
+
+    def get_message(self, key):
+        """M.get_message(key) -> mailbox.MaildirMessage
+
+        Parse and return the message.
+        """
+        return mailbox.MaildirMessage(self.get_bytes(key))
+
+    def get_headers(self, key):
+        """M.get_headers(key) -> email.message.Message
+
+        Parse and return the headers of the message in CACHEDHEADERS,
+        from the cache or else from the start of its file. Note that the
+        returned message is never multipart; check its content type.
+
+        """
+        return _HEADERPARSER(self._entry(key)[1])
+
+    def get_size(self, key):
+        """M.get_size(key) -> int
+
+        Return the size of the message in bytes.
+        """
+        return self._entry(key)[0]
+
+    def read_headers(self, numbers):
+        """M.read_headers(numbers) -> void
+
+        Read the headers of the messages in numbers that are not cached
+        yet, several files at a time. See save().
+        """
+        self._load()
+        with self._lock:
+            missing = [n for n in numbers
+                       if _unique(self._files[n]) not in self._headers]
+        if not missing:
+            return
+
+        paths = [self._lookup(n) for n in missing]
+        if len(paths) < 2 * READTHREADS:
+            entries = [_read_entry(path) for path in paths]
+        else:
+            pool = multiprocessing.pool.ThreadPool(READTHREADS)
+            try:
+                entries = pool.map(_read_entry, paths)
+            finally:
+                pool.terminate()
+                pool.join()
+
+        with self._lock:
+            for n, entry in zip(missing, entries):
+                if entry is not None:
+                    self._headers[_unique(self._files[n])] = entry
+                    self._dirty = True
+
+    def _lookup(self, key):
+        """Return the path of the file of message key"""
+        try:
+            if key < 0:
+                raise IndexError
+            return os.path.join(self._path, self._files[key])
+        except (IndexError, TypeError):
+            raise KeyError('No message with key: %s' % key)
+
+    def _entry(self, key):
+        """(size, cached headers) of message key, read if not cached"""
+        path = self._lookup(key)
+        self._load()
+        unique = _unique(self._files[key])
+        with self._lock:
+            entry = self._headers.get(unique)
+        if entry is None:
+            entry = _read_entry(path)
+            if entry is None:
+                raise KeyError('No message with key: %s' % key)
+            with self._lock:
+                self._headers[unique] = entry
+                self._dirty = True
+        return entry
+
+    def _load(self):
+        """Read the header cache the first time it is needed"""
+        with self._lock:
+            if self._headers is not None:
+                return
+
+            data = cache.load(self._cachepath)
+            if data is not None and data['version'] == CACHEVERSION:
+                self._headers = data['headers']
+            else:
+                self._headers = {}
+
+
+# =================================================================
+
+
+def is_maildir(path):
+    """is_maildir(path) -> Bool
+
+    Return True if path is a maildir folder: a directory with a cur
+    subdirectory. False otherwise.
+    """
+    return os.path.isdir(os.path.join(path, 'cur'))
+
+
+def _list(path):
+    """Names of the message files in directory path"""
+    if scandir is not None:
+        return [entry.name for entry in scandir(path)
+                if not entry.name.startswith('.') and entry.is_file()]
+    return [name for name in os.listdir(path)
+            if not name.startswith('.') and
+            os.path.isfile(os.path.join(path, name))]
+
+
+def _unique(name):
+    """Unique part of a message file name: without its subdirectory and
+    without the flags maildir appends to it"""
+    return name.rpartition('/')[2].partition(':')[0]
+
+
+def _key(unique):
+    """64 bit key of the message with unique file name"""
+    digest = hashlib.md5(unique.encode('utf-8')).digest()
+    return struct.unpack('<Q', digest[:8])[0]
+
+
+def _read_entry(path):
+    """(size, cached headers) of the message in file path, None if it
+    can not be read"""
+    try:
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            data, block = b'', mbox.HEADERBLOCK
+            while True:
+                data += f.read(block)
+                headers = data.replace(b'\r\n', b'\n')
+                end = headers.find(b'\n\n')
+                if end >= 0 or len(data) >= size:
+                    break
+                block *= 4  # Long headers, read more
+    except (IOError, OSError):
+        return None
+
+    if end >= 0:
+        headers = headers[:end + 1]
+    return size, b''.join(_CACHED.findall(headers))
+
+
+# =================================================================
+# Testing procedures.
+# Execute this module (python -m bluebird.maildir) to perform unit testing.
+# =================================================================
+
+if __name__ == '__main__':
+    import shutil
+    import tempfile
+    import unittest
+
+    MESSAGE = ('Received: from somewhere\n'
+               'Date: Sat, 05 Jan 2013 10:00:00 +0100\n'
+               'From: sender@example.com\n'
+               'Subject: message %d\n'
+               '\tcontinued\n'
+               '\n'
+               'Body %d\n')
+
+    class TestMaildir(unittest.TestCase):
+
+        def setUp(self):
+            self._dir = tempfile.mkdtemp()
+            cache.CACHEPATH = os.path.join(self._dir, 'cache')
+            self._path = os.path.join(self._dir, 'INBOX')
+            for subdir in ('cur', 'new', 'tmp'):
+                os.makedirs(os.path.join(self._path, subdir))
+            self.write('cur/1000.1.host:2,S', 0)
+            self.write('new/1001.1.host', 1)
+            self.write('cur/1002.1.host', 2)
+            self.write('tmp/1003.1.host', 3)  # Being delivered
+
+        def tearDown(self):
+            shutil.rmtree(self._dir)
+
+        def write(self, name, i):
+            with open(os.path.join(self._path, name), 'w') as f:
+                f.write(MESSAGE % (i, i))
+
+        def test_maildir(self):
+            md = Maildir(self._path)
+            self.assertEqual(len(md), 3)
+            self.assertEqual(md.size, 0)  # Nothing read yet
+            md.read_headers([0, 2])
+            self.assertEqual(md.size, sum(len(MESSAGE % (i, i))
+                                          for i in (0, 2)))
+            self.assertEqual(md[1]['subject'], 'message 1\n\tcontinued')
+            self.assertEqual(md.get_bytes(2),
+                             (MESSAGE % (2, 2)).encode('ascii'))
+            self.assertEqual([m.get_payload() for m in md],
+                             ['Body 0\n', 'Body 1\n', 'Body 2\n'])
+            self.assertRaises(KeyError, md.get_message, 3)
+            self.assertRaises(KeyError, md.get_headers, -1)
+            self.assertTrue(is_maildir(self._path))
+            self.assertFalse(is_maildir(os.path.join(self._path, 'cur')))
+
+        def test_headers(self):
+            md = Maildir(self._path)
+            headers = md.get_headers(0)
+            self.assertEqual(headers['from'], 'sender@example.com')
+            self.assertIsNone(headers['received'])  # Not cached
+            self.assertEqual(md.get_size(0), len(MESSAGE % (0, 0)))
+            md.close()
+
+            # Flags changed: same message, same key, cached
+            os.rename(os.path.join(self._path, 'cur/1000.1.host:2,S'),
+                      os.path.join(self._path, 'cur/1000.1.host:2,RS'))
+            keys = md.keys
+            md = Maildir(self._path)
+            self.assertEqual(md.keys, keys)
+            md._files[0] = 'cur/1000.1.host:2,missing'
+            self.assertEqual(md.get_headers(0)['subject'],
+                             'message 0\n\tcontinued')
+
+        def test_read_headers(self):
+            global READTHREADS
+            threads, READTHREADS = READTHREADS, 1
+            try:
+                for i in range(4, 40):
+                    self.write('cur/%d.1.host' % (1000 + i), i)
+                md = Maildir(self._path)
+                md.read_headers(range(len(md)))
+                self.assertEqual(len(md._headers), 39)
+                self.assertFalse(os.path.exists(md._cachepath))
+                md.save()
+
+                md = Maildir(self._path)
+                md._load()
+                self.assertEqual(len(md._headers), 39)  # Stored
+                os.remove(os.path.join(self._path, 'cur/1004.1.host'))
+                self.assertRaises(KeyError, md.get_bytes, 3)
+                self.assertEqual(md.get_headers(3)['subject'],
+                                 'message 4\n\tcontinued')
+            finally:
+                READTHREADS = threads
+
+        def test_threads(self):
+            for i in range(4, 400):
+                self.write('cur/%d.1.host' % (1000 + i), i)
+            md = Maildir(self._path)
+            errors = []
+
+            def read(numbers):
+                try:
+                    for n in numbers:
+                        md.get_headers(n)
+                        md.save()
+                except Exception as e:
+                    errors.append(e)
+
+            thread = threading.Thread(target=read, args=(range(0, 399, 2),))
+            thread.start()
+            read(range(1, 399, 2))
+            thread.join()
+            self.assertEqual(errors, [])
+            self.assertEqual(len(md._headers), 399)
+
+        def test_removed(self):
+            from . import search
+            from . import store
+
+            md = Maildir(self._path)
+            os.remove(os.path.join(self._path, 'new/1001.1.host'))
+            self.assertEqual(search.prefilter(md, 'Body'), [0, 2])
+            self.assertEqual(search.select(md, 'Body', [0, 1, 2]), [0, 2])
+            self.assertEqual(search.find(md, 'Body'), [0, 2])
+            hs = store.HeaderStore(md)
+            hs.fill()
+            self.assertEqual(hs.subjects, ['message 0\n\tcontinued', '',
+                                           'message 2\n\tcontinued'])
+
+    unittest.main()
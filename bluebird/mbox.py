@@ -0,0 +1,691 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""mbox mailbox reader
+
+Read only mbox reader built on mmap and positional reads, safe to use
+from several threads at once. Messages are located by a table of
+contents of start and stop offsets, held in two flat arrays of 64 bit
+integers (16 bytes per message), and are exposed as memoryview slices
+of the mapped file, so nothing is read or copied until a message is
+actually parsed.
+
+Scanning a big mbox for "From " lines takes long, so the table of
+contents is stored in a sidecar index and reused while the mbox file
+does not change. Thunderbird only appends new mail to an mbox file
+between compactions: when the file grew and the indexed prefix is
+untouched, only the new tail is scanned. Big scans are split in byte
+ranges scanned in parallel by worker processes.
+
+When there is no index yet, the offsets are taken from the Thunderbird
+summary of the file (see mork.Summary) if it describes the whole file,
+so only the headers of the messages are read. A stale summary is
+ignored and the file scanned instead. A summary that does not match the
+file at all, like those of IMAP folders not fully kept offline, is
+remembered and not read again until Thunderbird rewrites it.
+
+Every message also gets a 64 bit key, a digest of its headers and size.
+Compacting a folder moves messages around the file; the keys let data
+cached per message (see store.HeaderStore) follow them to their new
+position.
+
+classes:
+
+Mbox -- mmap backed mbox reader with a persistent table of contents
+
+"""
+import os
+import re
+import sys
+import array
+import struct
+import hashlib
+import mmap
+import mailbox
+import email.parser
+import email.message
+
+from . import cache
+from . import mork
+from . import parallel
+
+# Bump when the layout of the index changes
+INDEXVERSION = 4
+
+# Array type code of the table of contents offsets
+try:
+    array.array('Q')
+    TOCTYPE = 'Q'
+except ValueError:
+    TOCTYPE = 'L'  # Python 2: no 'Q', unsigned long is 64 bits on Linux
+
+# Size of each block of the file sampled by the prefix fingerprint
+FINGERPRINTBLOCK = 4096
+
+# Minimum size of the byte range scanned by each worker process
+SHARDSIZE = 64 * 1024 * 1024
+
+# Bytes read at once looking for the end of the headers
+HEADERBLOCK = 4096
+
+
+# Headers Thunderbird rewrites in place when the message flags change
+_VOLATILEHEADERS = re.compile(br'^X-Mozilla-(?:Status2?|Keys):.*\n'
+                              br'(?:[ \t].*\n)*', re.M | re.I)
+
+# Positional reads release the GIL while waiting for the disk, page
+# faults on the mapping do not. Python 2 has no pread: use the mapping.
+_pread = getattr(os, 'pread', None)
+
+if sys.version_info.major == 3:
+    _HEADERPARSER = email.parser.BytesHeaderParser().parsebytes
+else:
+    _HEADERPARSER = email.parser.HeaderParser().parsestr
+
+
+# =================================================================
+
+
+class Mbox(object):
+    """Read only mbox mailbox
+
+    Supports len(), indexing by message number (KeyError if there is no
+    such message) and iteration, like the mailbox.mbox objects used
+    before. Messages are returned as mailbox.mboxMessage objects.
+
+    There is no shared file position: messages are read with pread or
+    sliced from the mapping, and the table of contents never changes
+    after opening. Any number of threads may read messages at the same
+    time without locking. Do not close the mailbox while they do.
+
+    """
+
+    _path = None
+    _file = None
+    _map = None
+    _starts = None  # Message start offsets
+    _stops = None  # Message stop offsets
+    _keys = None  # Message keys
+    _summary = None  # Thunderbird summary, False if there is none
+
+    def __init__(self, path, toc=None):
+        """Open the mbox file in path
+
+        toc, if given, is a (starts, stops) pair of offset arrays used
+        instead of the index, e.g. by worker processes handling a part
+        of the mailbox.
+
+        """
+        self._path = path
+        self._indexpath = cache.sidecar_path(path, 'idx')
+
+        self._file = open(path, 'rb')
+        st = os.fstat(self._file.fileno())
+        if st.st_size > 0:
+            self._map = mmap.mmap(self._file.fileno(), st.st_size,
+                                  access=mmap.ACCESS_READ)
+        else:
+            self._map = b''  # mmap can not map empty files
+
+        if toc is None:
+            self._generate_toc(st)
+        else:
+            self._starts, self._stops = toc
+
+    def __len__(self):
+        return len(self._starts)
+
+    def __getitem__(self, key):
+        return self.get_message(key)
+
+    def __iter__(self):
+        for key in range(len(self)):
+            yield self.get_message(key)
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def data(self):
+        """The mapped mbox file, a read only buffer"""
+        return self._map
+
+    @property
+    def size(self):
+        """Size of the mbox file in bytes, when opened"""
+        return len(self._map)
+
+    @property
+    def toc(self):
+        """Arrays with the start and stop offsets of every message"""
+        return self._starts, self._stops
+
+    @property
+    def keys(self):
+        """Array with the key of every message
+
+        A message keeps its key when it moves inside the file, e.g. when
+        Thunderbird compacts the folder.
+        """
+        return self._keys
+
+    @property
+    def summary(self):
+        """Dict of the Thunderbird summary entries by message number
+
+        Each entry is the (offset, size, date, flags, sender, subject, key)
+        of a message (see mork.Summary); messages appended after the
+        summary was written have none. None if there is no summary or it
+        does not match the file: it is bigger or lists offsets where no
+        message starts.
+        """
+        summary = self._read_summary()
+        if summary is None:
+            return None
+        if summary.size is None or summary.size > len(self._map):
+            self._reject_summary()
+            return None
+
+        numbers = dict((start, n) for n, start in enumerate(self._starts))
+        entries = {}
+        for entry in summary.messages:
+            n = numbers.get(entry[0])
+            if n is None:
+                self._reject_summary()
+                return None
+            entries[n] = entry
+        return entries
+
+    def close(self):
+        """Release the mapping and the file"""
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+        self._file.close()
+
+    def get_bytes(self, key):
+        """M.get_bytes(key) -> memoryview
+
+        Return the raw message, From_ line included, as a slice of the
+        mapped file. No data is copied, except on Python 2, where the
+        slice is a copy.
+
+        """
+        start, stop = self._lookup(key)
+        try:
+            return memoryview(self._map)[start:stop]
+        except TypeError:
+            return self._map[start:stop]  # Python 2: mmap has no buffer
+
+    def get_message(self, key):
+        """M.get_message(key) -> mailbox.mboxMessage
+
+        Parse and return the message.
+        """
+        start, stop = self._lookup(key)
+        data = self._read(start, stop)
+        eol = data.find(b'\n')
+        if eol < 0:
+            eol = len(data)
+        msg = mailbox.mboxMessage(data[eol + 1:])
+        msg.set_from(data[5:eol].decode('ascii', 'replace'))
+        return msg
+
+    def get_headers(self, key):
+        """M.get_headers(key) -> email.message.Message
+
+        Parse and return the message headers only. The data read stops at
+        the first blank line, the body is never touched. Note that the
+        returned message is never multipart; check its content type.
+
+        """
+        start, stop = self._lookup(key)
+        size = HEADERBLOCK
+        while True:
+            data = self._read(start, min(start + size, stop))
+            end = data.find(b'\n\n')
+            if end >= 0 or start + size >= stop:
+                break
+            size *= 4  # Long headers, read more
+
+        eol = data.find(b'\n')
+        if eol < 0:
+            return email.message.Message()
+        end = len(data) if end < 0 else end + 1
+        return _HEADERPARSER(data[eol + 1:end])
+
+    def get_size(self, key):
+        """M.get_size(key) -> int
+
+        Return the size of the message in bytes.
+        """
+        start, stop = self._lookup(key)
+        return stop - start
+
+    def _read(self, start, stop):
+        """Return a copy of the bytes from start to stop"""
+        if _pread is not None:
+            return _pread(self._file.fileno(), stop - start, start)
+        return self._map[start:stop]
+
+    def _lookup(self, key):
+        """Return the (start, stop) offsets of the message key"""
+        try:
+            if key < 0:
+                raise IndexError
+            return self._starts[key], self._stops[key]
+        except (IndexError, TypeError):
+            raise KeyError('No message with key: %s' % key)
+
+    def _generate_toc(self, st):
+        """Generate the table of contents, reusing the index if valid"""
+        stamp = (st.st_size, st.st_mtime, st.st_ino)
+
+        index = cache.load(self._indexpath)
+        if index is not None and index['version'] != INDEXVERSION:
+            index = None
+
+        if index is not None and index['stamp'] == stamp:
+            starts, stops = index['starts'], index['stops']
+            keys = index['keys']
+        elif (index is not None and index['starts'] and
+              st.st_size >= index['length'] and
+              index['fingerprint'] == self._fingerprint(index['length'])):
+            # Mail was appended: rescan from the last known message,
+            # whose end moved if the previous write was incomplete.
+            starts, stops, keys = self._scan(index['starts'][-1])
+            starts = index['starts'][:-1] + starts
+            stops = index['stops'][:-1] + stops
+            keys = index['keys'][:-1] + keys
+        else:
+            toc = self._summary_toc()
+            if toc is None:
+                toc = self._scan(0)
+            starts, stops, keys = toc
+
+        self._starts, self._stops, self._keys = starts, stops, keys
+
+        if index is None or index['stamp'] != stamp:
+            cache.dump(self._indexpath,
+                       {'version': INDEXVERSION,
+                        'stamp': stamp,
+                        'length': st.st_size,
+                        'fingerprint': self._fingerprint(st.st_size),
+                        'starts': starts,
+                        'stops': stops,
+                        'keys': keys})
+
+    def _scan(self, offset):
+        """Return the start and stop offsets and the keys of the messages
+        found after offset
+
+        Big scans are split in byte ranges scanned by worker processes.
+
+        """
+        size = len(self._map)
+        shards = min(parallel.WORKERS, (size - offset) // SHARDSIZE)
+        if shards < 2:
+            return _scan(self._map, offset, size)
+
+        step = (size - offset) // shards
+        tasks = [(self._path, offset + i * step,
+                  size if i == shards - 1 else offset + (i + 1) * step)
+                 for i in range(shards)]
+
+        starts, stops, keys = (array.array(TOCTYPE), array.array(TOCTYPE),
+                               array.array(TOCTYPE))
+        for result in parallel.imap(_scan_shard, tasks):
+            starts += result[0]
+            stops += result[1]
+            keys += result[2]
+        return starts, stops, keys
+
+    def _read_summary(self):
+        """Return the Thunderbird summary of the file, None if there is
+        no readable one or it was rejected since it was last written"""
+        if self._summary is None:
+            self._summary = False
+            stamp = _stamp(self._path + '.msf')
+            rejected = cache.load(cache.sidecar_path(self._path, 'msr'))
+            if stamp is not None and rejected != stamp:
+                try:
+                    self._summary = mork.Summary(self._path + '.msf')
+                except (IOError, OSError, mork.MorkError):
+                    pass
+        return self._summary or None
+
+    def _reject_summary(self):
+        """Drop the summary, which does not match the file, and remember
+        it until Thunderbird writes it again"""
+        stamp = _stamp(self._path + '.msf')
+        if stamp is not None:
+            cache.dump(cache.sidecar_path(self._path, 'msr'), stamp)
+        self._summary = False
+
+    def _summary_toc(self):
+        """Return the start and stop offsets and the keys of the messages
+        listed by the Thunderbird summary, None if it does not describe
+        the file
+
+        Only the first line and the headers of each message are read.
+        Deleted messages Thunderbird did not compact away yet are left
+        out, as Thunderbird does.
+
+        """
+        summary = self._read_summary()
+        data = self._map
+        if summary is None or summary.size != len(data):
+            return None
+
+        starts, stops, keys = (array.array(TOCTYPE), array.array(TOCTYPE),
+                               array.array(TOCTYPE))
+        for entry in summary.messages:
+            start, size = entry[:2]
+            end = start + (size or 0)
+            if (start < (stops[-1] if stops else 0) or size is None or
+                    end > len(data) or
+                    data[start:start + 5] != b'From ' or
+                    start > 0 and data[start - 1:start] != b'\n' or
+                    end < len(data) and data[end:end + 5] != b'From '):
+                self._reject_summary()
+                return None
+            if data[end - 2:end] == b'\n\n':
+                end -= 1  # Separating blank line
+            starts.append(start)
+            stops.append(end)
+            keys.append(_digest(data, start, end))
+        return starts, stops, keys
+
+    def _fingerprint(self, length):
+        """Return a digest identifying the first length bytes of the file
+
+        Hashing the whole prefix would cost as much as scanning it, so
+        only its first, middle and last blocks are sampled. Appending
+        mail leaves them untouched, rewriting the file does not.
+
+        """
+        digest = hashlib.sha1(str(length).encode('ascii'))
+        for offset in (0, length // 2, length - FINGERPRINTBLOCK):
+            offset = max(0, offset)
+            digest.update(self._map[offset:offset +
+                                    min(FINGERPRINTBLOCK, length - offset)])
+        return digest.hexdigest()
+
+
+def _scan(data, first, last):
+    """Return the start and stop offsets and the keys of the messages
+    starting from first to last - 1 in data
+
+    Same rules as mailbox.mbox: a message starts at every line beginning
+    with "From " and the blank line before the next one does not belong
+    to the message. The last message may end after last.
+
+    """
+    starts, stops, keys = (array.array(TOCTYPE), array.array(TOCTYPE),
+                           array.array(TOCTYPE))
+
+    if data[first:first + 5] == b'From ' and \
+       (first == 0 or data[first - 1:first] == b'\n'):
+        pos = first
+    else:
+        pos = data.find(b'\nFrom ', first)
+        pos = pos + 1 if pos >= 0 else -1
+
+    while 0 <= pos < last:
+        start = pos
+        pos = data.find(b'\nFrom ', pos)
+        if pos < 0:
+            end = len(data)
+        else:
+            pos += 1
+            end = pos
+        if data[end - 2:end] == b'\n\n':
+            end -= 1  # Separating blank line
+        starts.append(start)
+        stops.append(end)
+        keys.append(_digest(data, start, end))
+
+    return starts, stops, keys
+
+
+def _scan_shard(task):
+    """Scan the byte range of an mbox file in a worker process"""
+    path, first, last = task
+    with open(path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return _scan(data, first, last)
+        finally:
+            data.close()
+
+
+def _stamp(path):
+    """Modification time and size of the file in path, None if missing"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return getattr(st, 'st_mtime_ns', st.st_mtime), st.st_size
+
+
+def _digest(data, start, stop):
+    """Return the key of the message from start to stop in data
+
+    The key is made of the message size and its headers, Message-ID
+    included. The From_ line and the headers Thunderbird updates with
+    the message flags are left out.
+
+    """
+    eol = data.find(b'\n', start, stop)
+    if eol < 0:
+        eol = stop
+    end = data.find(b'\n\n', eol, stop)
+    end = stop if end < 0 else end + 1
+    digest = hashlib.md5(_VOLATILEHEADERS.sub(b'', data[eol + 1:end]))
+    digest.update(str(stop - start).encode('ascii'))
+    return struct.unpack('<Q', digest.digest()[:8])[0]
+
+
+# =================================================================
+# Testing procedures.
+# Execute this module (python -m bluebird.mbox) to perform unit testing.
+# =================================================================
+
+if __name__ == '__main__':
+    import shutil
+    import tempfile
+    import unittest
+
+    MESSAGE = ('From - Sat Jan 01 00:00:00 2013\n'
+               'Date: Sat, 05 Jan 2013 10:00:00 +0100\n'
+               'From: sender@example.com\n'
+               'Subject: message %d\n'
+               '\n'
+               'Body %d\n'
+               '\n')
+
+    class TestMbox(unittest.TestCase):
+
+        def setUp(self):
+            self._dir = tempfile.mkdtemp()
+            cache.CACHEPATH = self._dir
+            self._path = self._dir + '/INBOX'
+            self.append(0, 3)
+
+        def tearDown(self):
+            shutil.rmtree(self._dir)
+
+        def append(self, first, last):
+            with open(self._path, 'a') as f:
+                for i in range(first, last):
+                    f.write(MESSAGE % (i, i))
+
+        def assertToc(self, mb):
+            """Compare the table of contents with that of mailbox.mbox"""
+            ref = mailbox.mbox(self._path)
+            self.assertEqual(len(mb), len(ref))
+            self.assertEqual(list(zip(mb._starts, mb._stops)),
+                             [ref._toc[k] for k in sorted(ref._toc)])
+
+        def test_mbox(self):
+            mb = Mbox(self._path)
+            self.assertToc(mb)
+            self.assertEqual(mb[2]['subject'], 'message 2')
+            self.assertEqual(mb[2].get_from(), '- Sat Jan 01 00:00:00 2013')
+            self.assertEqual(bytes(mb.get_bytes(1)),
+                             (MESSAGE % (1, 1))[:-1].encode('ascii'))
+            self.assertEqual([m['subject'] for m in mb],
+                             ['message 0', 'message 1', 'message 2'])
+            self.assertEqual(mb.get_headers(1)['subject'], 'message 1')
+            self.assertEqual(mb.get_headers(1).get_payload(), '')
+            self.assertRaises(KeyError, mb.__getitem__, 3)
+            self.assertRaises(KeyError, mb.__getitem__, -1)
+
+            open(self._path, 'w').close()
+            self.assertEqual(len(Mbox(self._path)), 0)
+
+        def test_index(self):
+            mb = Mbox(self._path)
+            self.assertTrue(os.path.exists(mb._indexpath))
+
+            # Reopening an unchanged mailbox reads the index
+            scanned = []
+
+            class ScanMbox(Mbox):
+                def _scan(self, offset):
+                    scanned.append(offset)
+                    return Mbox._scan(self, offset)
+
+            mb = ScanMbox(self._path)
+            self.assertEqual(scanned, [])
+            self.assertToc(mb)
+
+            # Only the tail is scanned after new mail arrives
+            self.append(3, 5)
+            mb = ScanMbox(self._path)
+            self.assertEqual(scanned, [2 * len(MESSAGE % (0, 0))])
+            self.assertToc(mb)
+            self.assertEqual(mb[4]['subject'], 'message 4')
+
+            # A rewritten prefix forces a full scan
+            with open(self._path, 'w') as f:
+                f.write((MESSAGE % (7, 7)) * 6)
+            mb = ScanMbox(self._path)
+            self.assertEqual(scanned[-1], 0)
+            self.assertToc(mb)
+            self.assertEqual(mb[0]['subject'], 'message 7')
+
+        def test_threads(self):
+            import threading
+
+            self.append(3, 40)
+            mb = Mbox(self._path)
+            subjects = [None] * len(mb)
+
+            def read(first):
+                for n in range(first, len(mb), 4):
+                    subjects[n] = (mb.get_headers(n)['subject'],
+                                   mb[n]['subject'])
+
+            threads = [threading.Thread(target=read, args=(i,))
+                       for i in range(4)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEqual(subjects, [('message %d' % n,) * 2
+                                        for n in range(40)])
+
+        def test_parallel(self):
+            global SHARDSIZE
+            self.append(3, 40)
+            serial = Mbox(self._path)
+            os.remove(serial._indexpath)
+
+            shardsize, parallel.WORKERS = SHARDSIZE, 4
+            SHARDSIZE = 100
+            try:
+                mb = Mbox(self._path)
+            finally:
+                SHARDSIZE = shardsize
+            self.assertToc(mb)
+            self.assertEqual(mb.keys, serial.keys)
+
+        def test_keys(self):
+            def write(numbers, read=()):
+                with open(self._path, 'w') as f:
+                    for i in numbers:
+                        status = '0001' if i in read else '0000'
+                        f.write((MESSAGE % (i, i)).replace(
+                            '\nDate', '\nX-Mozilla-Status: %s\nDate' % status))
+
+            write(range(5))
+            keys = Mbox(self._path).keys
+            self.assertEqual(len(set(keys)), 5)
+
+            # Compaction: message 1 expunged, message 3 marked as read
+            write((0, 2, 3, 4), read=(3,))
+            self.assertEqual(list(Mbox(self._path).keys),
+                             [keys[0], keys[2], keys[3], keys[4]])
+
+        def test_summary(self):
+            size = len(MESSAGE % (0, 0))
+            with open(self._path + '.msf', 'w') as f:
+                f.write('< <(a=c)> (80=ns:msg:db:row:scope:msgs:all)'
+                        '(81=subject)(87=size)(89=storeToken)'
+                        '(96=ns:msg:db:table:kind:msgs)'
+                        '(9A=ns:msg:db:row:scope:dbfolderinfo:all)'
+                        '(9B=ns:msg:db:table:kind:dbfolderinfo)'
+                        '(9E=folderSize)>\n'
+                        '{1:^9A {(k^9B:c)} [1(^9E=%x)]}\n'
+                        '{1:^80 {(k^96:c)} [1(^81=Summary 0)(^87=%x)'
+                        '(^89=0)] [3(^81=Summary 2)(^87=%x)(^89=%d)]}\n' %
+                        (3 * size, size, size, 2 * size))
+
+            scanned = []
+
+            class ScanMbox(Mbox):
+                def _scan(self, offset):
+                    scanned.append(offset)
+                    return Mbox._scan(self, offset)
+
+            # Message 1 deleted, not compacted yet
+            mb = ScanMbox(self._path)
+            self.assertEqual(scanned, [])
+            self.assertEqual([m['subject'] for m in mb],
+                             ['message 0', 'message 2'])
+            self.assertEqual(bytes(mb.get_bytes(1)),
+                             (MESSAGE % (2, 2))[:-1].encode('ascii'))
+            self.assertEqual(sorted(mb.summary), [0, 1])
+            self.assertEqual(mb.summary[1][5], 'Summary 2')
+
+            # Stale summary: scanned, but its entries are still used
+            self.append(3, 4)
+            os.remove(mb._indexpath)
+            mb = ScanMbox(self._path)
+            self.assertEqual(scanned, [0])
+            self.assertToc(mb)
+            self.assertEqual(sorted(mb.summary), [0, 2])
+
+            with open(self._path, 'w') as f:
+                f.write(MESSAGE % (0, 0))
+            self.assertIsNone(Mbox(self._path).summary)  # Shrunk
+
+            # Rejected: not parsed again until the summary changes
+            parsed = []
+            summary = mork.Summary
+            mork.Summary = lambda path: parsed.append(path) or summary(path)
+            try:
+                self.assertIsNone(Mbox(self._path).summary)
+                self.assertEqual(parsed, [])
+                with open(self._path + '.msf', 'a') as f:
+                    f.write('\n')
+                self.assertIsNone(Mbox(self._path).summary)
+                self.assertEqual(parsed, [self._path + '.msf'])
+            finally:
+                mork.Summary = summary
+
+    try:
+        assert sys.platform.startswith('linux')
+    except AssertionError:
+        raise AssertionError('Unsupported platform ' + sys.platform)
+    unittest.main()
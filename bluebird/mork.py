@@ -0,0 +1,392 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Mork database parser
+
+Thunderbird keeps a summary of every mbox file next to it, in a .msf
+file: the sender, subject, date, flags and offset of each message. The
+summary is a Mork database, a text format of dictionaries, tables and
+rows:
+
+    < <(a=c)> (80=ns:msg:db:row:scope:msgs:all)(81=subject)(82=sender) >
+    <(90=Hello)>
+    {1:^80 {(k^9B:c)(s=9)} [1(^81^90)(^82=Bob)] }
+
+A dictionary maps hexadecimal ids to atoms: column names when its meta
+dictionary holds (a=c), values otherwise. A row is a list of cells
+(column, value) where both can be literal or refer to an atom with ^id.
+Tables list rows, inline or by id, and their meta table gives their
+kind. Later edits are appended to the file, often in transaction groups
+(@$${id{@ ... @$$}id}@); aborted groups are dropped.
+
+Only what the summaries use is supported.
+
+classes:
+
+MorkError -- Invalid Mork data
+MorkParser -- Mork database parser
+Summary -- Messages of a Thunderbird folder summary
+
+"""
+import re
+import collections
+import email.message
+
+from . import utils
+
+### Module Constants ##
+
+# Table kinds of a folder summary
+KIND_MESSAGES = 'ns:msg:db:table:kind:msgs'
+KIND_FOLDERINFO = 'ns:msg:db:table:kind:dbfolderinfo'
+
+# Thunderbird message flags (nsMsgMessageFlags)
+MSG_FLAG_EXPUNGED = 0x8
+MSG_FLAG_HASRE = 0x10  # Subject had a 'Re:' prefix, stripped
+MSG_FLAG_ATTACHMENT = 0x10000000
+
+# Message columns read from a summary
+_COLUMNS = ('storeToken', 'msgOffset', 'size', 'date', 'flags', 'sender',
+            'subject')
+
+_VALUE = br'[^)\\]*(?:\\.[^)\\]*)*'
+_CELL = re.compile(br'//[^\n]*|\(\s*(\^?)([^=^)\s]+)\s*([=^])(' + _VALUE +
+                   br')\)', re.S)
+_CELLS = (br'(?://[^\n]*|\(' + _VALUE +
+          br'\)|[^()<>{}\[\]/]+|/)*')
+
+_TOKEN = re.compile(
+    br'\s+|//[^\n]*'
+    br'|@\$\$\{[0-9A-Fa-f]+\{@|@\$\$\}[0-9A-Fa-f]+\}@'  # Group limits
+    br'|(?P<dict><\s*(?P<meta><' + _CELLS + br'>)?(?P<atoms>' + _CELLS +
+    br')>)'
+    br'|(?P<row>\[\s*(?P<rowcut>-?)(?P<rowid>[0-9A-Fa-f]+)'
+    br'(?::(?P<rowscope>[^\s()\[\]]+))?(?P<cells>' + _CELLS + br')\])'
+    br'|(?P<table>\{\s*(?P<tablecut>-?)(?P<tableid>[0-9A-Fa-f]+)'
+    br'(?::(?P<tablescope>[^\s(){}\[\]]+))?\s*'
+    br'(?:\{(?P<tablemeta>' + _CELLS + br')\})?)'
+    br'|(?P<end>\})'
+    br'|(?P<ref>(?P<refcut>-?)(?P<refid>[0-9A-Fa-f]+)'
+    br'(?::(?P<refscope>[^\s()\[\]{}]+))?)', re.S)
+
+_ABORTED = re.compile(br'@\$\$\{([0-9A-Fa-f]+)\{@.*?@\$\$\}~~\}\1\}@', re.S)
+
+_ESCAPE = re.compile(br'\\\r?\n|\\(.)|\$([0-9A-Fa-f]{2})', re.S)
+
+
+# =================================================================
+
+
+class MorkError(ValueError):
+    """Invalid Mork data"""
+
+
+class MorkParser(object):
+    """Mork database parser"""
+
+    def __init__(self, filename=None):
+        self._atoms = {}  # Value atoms by id
+        self._columns = {}  # Column names by id
+        self._rows = {}  # (scope, id) -> {column: raw value}
+        self._tables = {}  # (scope, id) -> [kind, [row keys], scope]
+        self._rowscope = None  # Scope of the rows without one
+        self._names = {}  # Column names by cell column
+
+        if filename is not None:
+            with open(filename, 'rb') as f:
+                self.read(f.read())
+
+    def read(self, data):
+        """P.read(data) -> void
+
+        Parse Mork data, given as bytes. Raise MorkError if it is not
+        valid.
+        """
+        data = _ABORTED.sub(b'', data)
+        table = None
+        pos = 0
+        while pos < len(data):
+            match = _TOKEN.match(data, pos)
+            if match is None:
+                raise MorkError('Invalid Mork data at offset %d' % pos)
+            pos = match.end()
+
+            if match.group('dict') is not None:
+                self._dict(match.group('meta'), match.group('atoms'))
+            elif match.group('row') is not None:
+                key = self._row(match.group('rowcut'), match.group('rowid'),
+                                match.group('rowscope'),
+                                match.group('cells'), table)
+                if table is not None:
+                    table[1][key] = None
+            elif match.group('table') is not None:
+                table = self._table(match.group('tablecut'),
+                                    match.group('tableid'),
+                                    match.group('tablescope'),
+                                    match.group('tablemeta'))
+            elif match.group('end') is not None:
+                table = None
+            elif match.group('ref') is not None:
+                if table is None:
+                    raise MorkError('Row reference out of a table at '
+                                    'offset %d' % match.start())
+                key = (self._scope(match.group('refscope')) or table[2],
+                       int(match.group('refid'), 16))
+                if match.group('refcut'):
+                    table[1].pop(key, None)
+                else:
+                    table[1][key] = None
+
+    def get_rows(self, kind, columns=None):
+        """P.get_rows(kind, columns=None) -> list
+
+        Return the (id, cells) pairs of the rows of the tables of kind,
+        where cells is a dict of the column names and values. If columns
+        is given, only those columns are returned.
+        """
+        result = []
+        for scope, tableid in sorted(self._tables):
+            table = self._tables[scope, tableid]
+            if table[0] != kind:
+                continue
+            for key in table[1]:
+                cells = self._rows.get(key, {})
+                if columns is not None:
+                    cells = dict((name, cells[name]) for name in columns
+                                 if name in cells)
+                result.append((key[1], dict((name, _unescape(value))
+                                            for name, value in
+                                            cells.items())))
+        return result
+
+    def _dict(self, meta, atoms):
+        """Add the atoms of a dictionary"""
+        target = self._atoms
+        for cell in _cells(meta or b''):
+            if cell[1] == b'a' and cell[3] == b'c':
+                target = self._columns
+        for cell in _cells(atoms):
+            target[int(cell[1], 16)] = cell[3]
+
+    def _row(self, cut, rowid, scope, cells, table):
+        """Add or edit a row, return its key"""
+        key = (self._scope(scope) or self._rowscope, int(rowid, 16))
+        if cut or key not in self._rows:
+            self._rows[key] = {}
+        row = self._rows[key]
+        names = self._names
+        for caret, column, op, value in _CELL.findall(cells):
+            if not column:
+                continue  # Comment
+            name = names.get(caret + column)
+            if name is None:
+                name = column
+                if caret:
+                    name = self._columns.get(int(column, 16), b'')
+                name = names[caret + column] = name.decode('utf-8',
+                                                           'replace')
+            row[name] = value if op == b'=' else self._value(op, value)
+        return key
+
+    def _table(self, cut, tableid, scope, meta):
+        """Return the table edited from now on: [kind, rows, row scope]"""
+        scope = self._rowscope = self._scope(scope)
+        key = (scope, int(tableid, 16))
+        table = self._tables.get(key)
+        if table is None or cut:
+            table = self._tables[key] = [None, collections.OrderedDict(),
+                                         scope]
+        for caret, column, op, value in _cells(meta or b''):
+            if column == b'k':
+                table[0] = self._value(op, value).decode('utf-8', 'replace')
+        return table
+
+    def _scope(self, scope):
+        """Name of a row or table scope, None if not given"""
+        if not scope:
+            return None
+        if scope.startswith(b'^'):
+            scope = self._value(b'^', scope[1:].split(b':')[0] + b':c')
+        return scope.decode('utf-8', 'replace')
+
+    def _value(self, op, value):
+        """Raw value of a cell, looking atoms up"""
+        if op == b'=':
+            return value
+        ref, colon, scope = value.partition(b':')
+        atoms = self._columns if scope == b'c' else self._atoms
+        try:
+            return atoms[int(ref, 16)]
+        except (KeyError, ValueError):
+            return b''
+
+
+class Summary(object):
+    """Messages of a Thunderbird folder summary
+
+    messages is the list of the (offset, size, date, flags, sender,
+    subject, key) of the messages in the mbox file, by ascending offset:
+    size in bytes up to the next message (None if unknown), date in
+    seconds since the epoch (None if unknown), flags as MSG_FLAG_*
+    values, the headers decoded to str like those of the mbox parser
+    (UTF-8 on Python 2) and the Thunderbird message key.
+    Expunged messages are left out.
+    size is the size of the mbox file when it was summarized, None if
+    unknown.
+
+    Raise MorkError or IOError if the summary can not be read.
+
+    """
+
+    size = None
+    messages = None
+
+    def __init__(self, path):
+        parser = MorkParser(path)
+
+        for rowid, cells in parser.get_rows(KIND_FOLDERINFO):
+            if 'folderSize' in cells:
+                self.size = _int(cells['folderSize'], 16)
+
+        self.messages = []
+        for rowid, cells in parser.get_rows(KIND_MESSAGES, _COLUMNS):
+            flags = _int(cells.get('flags', ''), 16) or 0
+            if flags & MSG_FLAG_EXPUNGED:
+                continue
+
+            # Local folders: the offset is the store token, formerly the
+            # msgOffset column or the message key
+            offset = _int(cells.get('storeToken', ''), 10)
+            if offset is None:
+                offset = _int(cells.get('msgOffset', ''), 16)
+            if offset is None:
+                offset = rowid
+
+            subject = _header(cells.get('subject', ''))
+            if flags & MSG_FLAG_HASRE:
+                subject = 'Re: ' + subject
+            self.messages.append((offset, _int(cells.get('size', ''), 16),
+                                  _int(cells.get('date', ''), 16), flags,
+                                  _header(cells.get('sender', '')),
+                                  subject, rowid))
+        self.messages.sort()
+
+
+# =================================================================
+
+
+def _cells(data):
+    """(caret, column, op, value) of the cells in data, comments left out"""
+    return [cell for cell in _CELL.findall(data) if cell[1]]
+
+
+def _unescape(value):
+    """Text of a raw value: backslash and $xx escapes, UTF-8"""
+    if b'\\' in value or b'$' in value:
+        value = _ESCAPE.sub(_unescape_match, value)
+    return value.decode('utf-8', 'replace')
+
+
+def _unescape_match(match):
+    """Replacement of an escape sequence"""
+    if match.group(1) is not None:
+        return match.group(1)
+    elif match.group(2) is not None:
+        return bytes(bytearray([int(match.group(2), 16)]))
+    return b''  # Line continuation
+
+
+def _int(text, base):
+    """Integer value of text, None if it is not a number"""
+    try:
+        return int(text, base)
+    except ValueError:
+        return None
+
+
+def _header(text):
+    """Decoded header, as store.HeaderStore decodes them"""
+    text = _native(text)
+    if '=?' not in text:
+        return text.strip()
+    message = email.message.Message()
+    message['header'] = text
+    return _native(utils.get_header_param(message, 'header')).strip()
+
+
+def _native(text):
+    """text as the mbox parser returns headers: UTF-8 bytes on Python 2"""
+    if not isinstance(text, str):
+        text = text.encode('utf-8')
+    return text
+
+
+# =================================================================
+# Testing procedures.
+# Execute this module (python -m bluebird.mork) to perform unit testing.
+# =================================================================
+
+if __name__ == '__main__':
+    import os
+    import shutil
+    import tempfile
+    import unittest
+
+    MSF = (b'// <!-- <mdb:mork:z v="1.4"/> -->\n'
+           b'< <(a=c)> // (f=iso-8859-1)\n'
+           b'  (80=ns:msg:db:row:scope:msgs:all)(81=subject)(82=sender)\n'
+           b'  (86=date)(87=size)(88=flags)(89=storeToken)\n'
+           b'  (96=ns:msg:db:table:kind:msgs)\n'
+           b'  (9A=ns:msg:db:row:scope:dbfolderinfo:all)\n'
+           b'  (9B=ns:msg:db:table:kind:dbfolderinfo)(9E=folderSize)>\n'
+           b'\n'
+           b'<(90=Hello \\) world)(91=Bob)(92=caf$C3$A9)>\n'
+           b'{1:^9A {(k^9B:c)(s=9)} [1:^9A(^9E=1F4)]}\n'
+           b'{1:^80 {(k^96:c)(s=9)} [0(^81^90)(^82^91)(^86=50E7F1A0)\n'
+           b'  (^88=11)(^89=0)]\n'
+           b'  [2(^81=Lunch)(^82=Alice)(^88=8)(^89=120)]\n'
+           b'  [3(^81^92)(^82==?utf-8?q?Carol?=)(^87=30)(^88=10000000)\n'
+           b'  (^89=200)]}\n'
+           b'@$${5{@[3(^81=D$C3$AEner)]@$$}5}@\n'
+           b'@$${6{@[3(^81=Ignored)]@$$}~~}6}@\n'
+           b'@$${7{@{1:^80 -0 }@$$}7}@\n')
+
+    class TestMork(unittest.TestCase):
+
+        def setUp(self):
+            self._dir = tempfile.mkdtemp()
+            self._path = os.path.join(self._dir, 'INBOX.msf')
+            with open(self._path, 'wb') as f:
+                f.write(MSF)
+
+        def tearDown(self):
+            shutil.rmtree(self._dir)
+
+        def test_parser(self):
+            parser = MorkParser(self._path)
+            rows = parser.get_rows(KIND_MESSAGES)
+            self.assertEqual([rowid for rowid, cells in rows], [2, 3])
+            self.assertEqual(rows[1][1]['subject'], u'D\xeener')
+            self.assertEqual(parser.get_rows(KIND_FOLDERINFO)[0][1],
+                             {'folderSize': '1F4'})
+            self.assertRaises(MorkError, MorkParser().read, b'[1(^80=x)')
+
+        def test_summary(self):
+            parser = MorkParser()
+            parser.read(MSF.split(b'@$$')[0])
+            self.assertEqual(parser.get_rows(KIND_MESSAGES)[0][1]['subject'],
+                             'Hello ) world')
+            self.assertEqual(parser.get_rows(KIND_MESSAGES)[2][1]['subject'],
+                             u'caf\xe9')
+
+            summary = Summary(self._path)
+            self.assertEqual(summary.size, 500)
+            self.assertEqual(summary.messages,
+                             [(200, 48, None, 0x10000000, 'Carol',
+                               'Dîner', 3)])
+            # Same type as the headers of the mbox parser
+            self.assertTrue(isinstance(summary.messages[0][5], str))
+
+            os.remove(self._path)
+            self.assertRaises(IOError, Summary, self._path)
+
+    unittest.main()
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Process pool helpers
+
+Work on big mailboxes (indexing, parsing, searching) is split into
+independent tasks, each covering a range of the mailbox, and run in a
+pool of worker processes, one per core.
+
+functions:
+
+imap -- Run a function over a list of tasks, yielding results in order
+
+"""
+import multiprocessing
+
+### Module Constants ##
+
+try:
+    WORKERS = multiprocessing.cpu_count()
+except NotImplementedError:
+    WORKERS = 1
+
+
+# =================================================================
+
+
+def imap(func, tasks):
+    """Run func over tasks in worker processes
+
+    Yield the results in the order of tasks, as soon as each is ready.
+    func must be a module level function and tasks picklable. A single
+    task, or a single core, runs in this process. Closing the generator
+    before it is exhausted terminates the workers.
+
+    """
+    if WORKERS < 2 or len(tasks) < 2:
+        for task in tasks:
+            yield func(task)
+        return
+
+    pool = multiprocessing.Pool(min(WORKERS, len(tasks)))
+    try:
+        for result in pool.imap(func, tasks):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
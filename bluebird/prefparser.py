@@ -2,12 +2,20 @@
 # -*- coding: utf-8 -*-
 """prefs.js file parser
 
-This parser is limited to extracting the different mail directories.
-
 A prefs.js file consists of javascript calls to a user_pref function.
 This function takes a string key as its first argument and a value of
 any type as its second argument.
 
+Every preference is read. The mail directories are those of the live
+accounts: mail.accountmanager.accounts lists them, the server of each
+account is mail.account.<account>.server and the directory of a server
+is mail.server.<server>.directory-rel, relative to the profile, or
+mail.server.<server>.directory. Accounts that were deleted leave their
+server preferences behind, and are not listed.
+
+The preferences read from a file are cached with its modification time,
+so an unchanged file is not parsed again.
+
 class:
 
 PrefParser -- responsible for parsing a prefs.js preferences file and
@@ -18,17 +26,39 @@ import sys
 import re
 import os
 import os.path
+import json
+
+from . import cache
+
+### Module Constants ##
+
+# Bump when the layout of the cache changes
+CACHEVERSION = 1
+
+_PREF = re.compile(r'user_pref\(\s*("(?:[^"\\]|\\.)*")\s*,\s*'
+                   r'("(?:[^"\\]|\\.)*"|[-+]?\d+|true|false)\s*\)\s*;')
+
+_PROFD = '[ProfD]'
+
+
+# =================================================================
 
 
 class PrefParser(object):
     """prefs.js file parser"""
 
+    _data = None  # key -> value
+    _profile = None  # Profile directory, where directory-rel start
+
     def __init__(self, filename=None):
         self._data = {}
 
         if filename is not None:
-            with open(filename) as f:
-                self.read_file(f)
+            self._profile = os.path.dirname(os.path.abspath(filename))
+            if not self._load(filename):
+                with open(filename) as f:
+                    self.read_file(f)
+                self._dump(filename)
 
     # =================================================================
 
@@ -51,56 +81,157 @@ class PrefParser(object):
     # =================================================================
 
     def _read(self, fp, fpname):
-        """Parse the file search for the mail directories"""
-        for line in fp:
-            if not line.startswith('user_pref'):
-                continue
+        """Parse the preferences of the file"""
+        for match in _PREF.finditer(''.join(fp)):
+            key, value = match.groups()
+            self._data[_string(key)] = _value(value)
+
+    def _load(self, filename):
+        """Read the cached preferences of filename if it is unchanged,
+        return True if they were read"""
+        data = cache.load(cache.sidecar_path(filename, 'prf'))
+        if (data is None or data['version'] != CACHEVERSION or
+                data['stamp'] != _stamp(filename)):
+            return False
+        self._data = data['prefs']
+        return True
+
+    def _dump(self, filename):
+        """Cache the preferences read from filename"""
+        cache.dump(cache.sidecar_path(filename, 'prf'),
+                   {'version': CACHEVERSION, 'stamp': _stamp(filename),
+                    'prefs': self._data})
 
-            # Filter by 'mail.server' preferences
-            match = re.search(r'mail\.server', line)
-            if not match:
-                continue
+    # =================================================================
 
-            # Get directory preferences
-            line = line.strip()[10:-2]  # Remove user_pref();\n
-            fields = line.partition(',')
+    def get(self, key, default=None):
+        """Return the value of the preference key, default if not set"""
+        return self._data.get(key, default)
 
-            key = fields[0].strip('"')
-            if key[-9:] != 'directory':
-                continue
+    def get_accounts(self):
+        """Return the accounts of the account manager"""
+        accounts = self.get('mail.accountmanager.accounts', '')
+        return [a.strip() for a in accounts.split(',') if a.strip()]
 
-            value = fields[2].lstrip().strip('"')
-            self._data[key] = value
+    def get_servers(self):
+        """Return the servers of the accounts, in account order
 
-    # =================================================================
+        Without an account list, every server with a directory is
+        returned.
 
-    def get_directories(self):
-        """Return the found mail directories"""
-        #return [self._data[i] for i in self._data]
+        """
+        if 'mail.accountmanager.accounts' not in self._data:
+            return sorted(set(
+                key.split('.')[2] for key in self._data
+                if re.match(r'mail\.server\.[^.]+\.directory(-rel)?$', key)))
+
+        servers = []
+        for account in self.get_accounts():
+            server = self.get('mail.account.%s.server' % account)
+            if server and server not in servers:
+                servers.append(server)
+
+        local = self.get('mail.accountmanager.localfoldersserver')
+        if local and local not in servers:
+            servers.append(local)
+        return servers
+
+    def get_directory(self, server):
+        """Return the mail directory of server, None if it has none"""
+        prefix = 'mail.server.%s.' % server
+        relative = self.get(prefix + 'directory-rel')
+        if (relative and relative.startswith(_PROFD) and
+                self._profile is not None):
+            path = os.path.join(self._profile, relative[len(_PROFD):])
+            if os.path.isdir(path):
+                return os.path.normpath(path)
+        return self.get(prefix + 'directory')
+
+    def get_directories(self, recursive=True):
+        """Return the found mail directories
+
+        These are the directories of the servers of the live accounts.
+        If recursive is True, the directories of their subfolders
+        (folder.sbd, see _get_directories_recursive) follow each of them.
+
+        """
         dirs = []
-        for key in self._data:
-            dirs.append(self._data[key])
-            dirs += self._get_directories_recursive(self._data[key])
+        for server in self.get_servers():
+            path = self.get_directory(server)
+            if not path or path in dirs:
+                continue
+            dirs.append(path)
+            if recursive:
+                dirs += self._get_directories_recursive(path)
         return dirs
 
     def _get_directories_recursive(self, path):
+        """The subfolders of the folder in file name are kept in directory
+        name.sbd; other directories are not folders"""
         d = []
-        for filename in os.listdir(path):
+        try:
+            names = sorted(os.listdir(path))
+        except OSError:
+            return d
+        for filename in names:
             p = '/'.join((path, filename))
-            if os.path.isdir(p):
+            if filename.endswith('.sbd') and os.path.isdir(p):
                 d.append(p)
                 d += self._get_directories_recursive(p)
         return d
 
 
+# =================================================================
+
+
+def _string(text):
+    """Value of a quoted javascript string"""
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text[1:-1]  # Invalid escape: take it as it is
+
+
+def _value(text):
+    """Value of a javascript string, integer or boolean literal"""
+    if text.startswith('"'):
+        return _string(text)
+    elif text in ('true', 'false'):
+        return text == 'true'
+    return int(text)
+
+
+def _stamp(filename):
+    """Modification time and size of a file, to tell if it changed"""
+    st = os.stat(filename)
+    return getattr(st, 'st_mtime_ns', st.st_mtime), st.st_size
+
+
 # =================================================================
 # Testing procedures.
-# Execute this file directly to perform unit testing.
+# Execute this module (python -m bluebird.prefparser) to perform unit
+# testing.
 # =================================================================
 
 if __name__ == '__main__':
+    import shutil
+    import tempfile
     import unittest
-    import profileparser
+    from . import profileparser
+
+    PREFS = r'''// Mozilla User Preferences
+user_pref("mail.account.account1.server", "server1");
+user_pref("mail.account.account2.server", "server2");
+user_pref("mail.accountmanager.accounts", "account1,account2");
+user_pref("mail.accountmanager.localfoldersserver", "server2");
+user_pref("mail.server.server1.directory", "/nowhere/imap.example.com");
+user_pref("mail.server.server1.directory-rel", "[ProfD]ImapMail/imap.example.com");
+user_pref("mail.server.server1.check_time", -5);
+user_pref("mail.server.server2.directory", "%s");
+user_pref("mail.server.server2.name", "Local \"Folders\" \u00e9; (x)");
+user_pref("mail.server.server3.directory", "/deleted/account");
+user_pref("mail.server.server3.login_at_startup", true);
+'''
 
     class TestPrefParser(unittest.TestCase):
 
@@ -137,6 +268,65 @@ if __name__ == '__main__':
             self.assertIn('Local Folders', dirs[0])
             self.assertIn('imap.googlemail.com', dirs[1])
 
+    class TestAccounts(unittest.TestCase):
+
+        def setUp(self):
+            cache.CACHEPATH = tempfile.mkdtemp()
+            self._profile = tempfile.mkdtemp()
+            self._local = os.path.join(self._profile, 'Mail', 'Local Folders')
+            for path in ('ImapMail/imap.example.com/INBOX.sbd/Work.sbd',
+                         'ImapMail/imap.example.com/filters',
+                         'Mail/Local Folders'):
+                os.makedirs(os.path.join(self._profile, path))
+            self._prefs = os.path.join(self._profile, 'prefs.js')
+            with open(self._prefs, 'w') as f:
+                f.write(PREFS % self._local)
+
+        def tearDown(self):
+            shutil.rmtree(cache.CACHEPATH)
+            shutil.rmtree(self._profile)
+
+        def test_prefs(self):
+            pparser = PrefParser(self._prefs)
+            self.assertEqual(pparser.get('mail.server.server1.check_time'), -5)
+            self.assertEqual(pparser.get('mail.server.server2.name'),
+                             u'Local "Folders" \u00e9; (x)')
+            self.assertIs(
+                pparser.get('mail.server.server3.login_at_startup'), True)
+            self.assertIsNone(pparser.get('mail.server.server4.name'))
+            self.assertEqual(pparser.get_servers(), ['server1', 'server2'])
+
+            # No account list: every server with a directory
+            pparser = PrefParser()
+            pparser.read_file([line for line in PREFS.splitlines(True)
+                               if 'accountmanager' not in line])
+            self.assertEqual(pparser.get_servers(),
+                             ['server1', 'server2', 'server3'])
+
+        def test_directories(self):
+            imap = os.path.join(self._profile, 'ImapMail', 'imap.example.com')
+            pparser = PrefParser(self._prefs)
+            self.assertEqual(pparser.get_directories(recursive=False),
+                             [imap, self._local])
+            self.assertEqual(pparser.get_directories(),
+                             [imap, imap + '/INBOX.sbd',
+                              imap + '/INBOX.sbd/Work.sbd', self._local])
+
+        def test_cache(self):
+            PrefParser(self._prefs)
+            read = []
+            _read = PrefParser._read
+            PrefParser._read = lambda self, fp, name: read.append(name)
+            try:
+                PrefParser(self._prefs)
+                self.assertEqual(read, [])  # Unchanged: cached
+                with open(self._prefs, 'a') as f:
+                    f.write('user_pref("x", 1);\n')
+                PrefParser(self._prefs)
+                self.assertEqual(read, [self._prefs])
+            finally:
+                PrefParser._read = _read
+
     try:
         assert sys.platform.startswith('linux')
     except AssertionError:
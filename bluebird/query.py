@@ -0,0 +1,889 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Mailbox search queries
+
+A query combines terms with AND (or nothing), OR and NOT (or a leading
+'-'), grouped with parentheses:
+
+    from:bob subject:invoice date:2023
+    (from:alice OR from:bob) -has:attachment size:>1M
+    "exact phrase" NOT date:2012..2013-06
+
+Terms:
+
+word, "phrase" -- from, subject or main content contain it (case
+                  sensitive)
+from:x, subject:x -- the header contains x (case insensitive)
+date:x -- sent on the year, month or day x, given as yyyy, yyyy-mm,
+          yyyy-mm-dd or dd/mm/yyyy. date:x..y is a range of days, both
+          included; either end can be left out
+size:x -- message size at least x bytes; also size:>x, size:<x and
+          size:x..y. Sizes take k, m and g suffixes
+has:attachment -- multipart messages
+fts:x -- the full-text index of the mail client (see gloda.GlodaIndex)
+         finds x, as words in any order; without an index for the
+         mailbox, as the word term x
+
+Text without any of this syntax is searched as a single phrase, and the
+old keyword prefixes ('from x', 'subject x', 'date dd/mm/yyyy
+[dd/mm/yyyy]' and their initials) still work.
+
+A query compiles into a plan: a tree whose operands are ordered from
+the cheapest to the most expensive. Terms on the header columns cost
+little, full-text terms cost a parse of every message they check. Each
+operand is only evaluated on the messages still undecided by the ones
+before it, so a query such as 'from:bob subject:invoice date:2023' never
+reads a message body, and a full-text term after cheap ones only parses
+the few messages left. Intermediate results are bitmaps held in Python
+integers, one bit per message.
+
+classes:
+
+QueryError -- Invalid query
+Query -- Base class of the plan nodes
+
+functions:
+
+compile -- Compile a query string into a plan
+narrows -- Test whether a query only matches messages matching another
+run -- Run a plan over a mailbox, range by range
+
+"""
+import re
+import time
+import bisect
+import binascii
+import calendar
+
+from . import search
+from . import store
+
+### Module Constants ##
+
+FIELDS = {'from': 'from', 'f': 'from',
+          'subject': 'subject', 's': 'subject',
+          'date': 'date', 'd': 'date',
+          'size': 'size',
+          'has': 'has',
+          'fts': 'fts'}
+
+# Plan costs: relative price of evaluating a term on one message
+COLUMNCOST = 1  # Compare numbers in the header store
+HEADERCOST = 2  # Search text in the header store
+TEXTCOST = 100  # Scan the raw message and parse it if needed
+
+RANGESIZE = 16384  # Most messages evaluated between two partial results
+
+_TOKEN = re.compile(r'\s*(?:([()])|((?:\w+:)?"[^"]*"?)|([^\s()]+))')
+
+_UNITS = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+
+_DAY = 86400
+
+
+# =================================================================
+
+
+class QueryError(ValueError):
+    """Invalid query"""
+
+
+class Query(object):
+    """Base class of the plan nodes
+
+    evaluate() returns the bitmap of the messages from first to last - 1
+    matching the node, bit i standing for message first + i. Only the
+    messages in bitmap within need an answer: the others may be set or
+    not.
+
+    """
+
+    cost = 0
+    headers = False  # Needs the header store loaded
+    cacheable = True  # Same result as long as the mailbox is unchanged
+
+    def evaluate(self, context, first, last, within):
+        """Q.evaluate(context, first, last, within) -> int"""
+        raise NotImplementedError
+
+    def key(self):
+        """Q.key() -> tuple
+
+        Canonical form of the node, the same for queries that only differ
+        in spacing, quoting or operand order.
+        """
+        raise NotImplementedError
+
+
+class And(Query):
+
+    def __init__(self, operands):
+        self.operands = sorted(operands, key=lambda q: q.cost)
+        self.cost = sum(q.cost for q in self.operands)
+        self.headers = any(q.headers for q in self.operands)
+        self.cacheable = all(q.cacheable for q in self.operands)
+
+    def key(self):
+        return ('and',) + tuple(sorted(q.key() for q in self.operands))
+
+    def evaluate(self, context, first, last, within):
+        for operand in self.operands:
+            if not within:
+                break
+            within &= operand.evaluate(context, first, last, within)
+        return within
+
+
+class Or(Query):
+
+    def __init__(self, operands):
+        self.operands = sorted(operands, key=lambda q: q.cost)
+        self.cost = sum(q.cost for q in self.operands)
+        self.headers = any(q.headers for q in self.operands)
+        self.cacheable = all(q.cacheable for q in self.operands)
+
+    def key(self):
+        return ('or',) + tuple(sorted(q.key() for q in self.operands))
+
+    def evaluate(self, context, first, last, within):
+        result = 0
+        for operand in self.operands:
+            left = within & ~result  # Messages not matched yet
+            if not left:
+                break
+            result |= operand.evaluate(context, first, last, left)
+        return result & within
+
+
+class Not(Query):
+
+    def __init__(self, operand):
+        self.operand = operand
+        self.cost = operand.cost
+        self.headers = operand.headers
+        self.cacheable = operand.cacheable
+
+    def key(self):
+        return ('not', self.operand.key())
+
+    def evaluate(self, context, first, last, within):
+        return within & ~self.operand.evaluate(context, first, last, within)
+
+
+class Text(Query):
+    """From, subject or main content contain pattern"""
+
+    cost = TEXTCOST
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+
+    def key(self):
+        return ('text', self.pattern)
+
+    def evaluate(self, context, first, last, within):
+        numbers = context.candidates(self.pattern)
+        if numbers is None:
+            within &= _spans(context.ranges(self.pattern), first, last)
+            if not within:
+                return 0
+
+        if numbers is not None:
+            numbers = numbers[bisect.bisect_left(numbers, first):
+                              bisect.bisect_left(numbers, last)]
+        elif _count(within) * 8 < last - first:
+            numbers = _numbers(within, first)
+        else:
+            # Most messages are left: one raw scan of the range is
+            # cheaper than checking them one by one
+            numbers = search.prefilter(context.mailbox, self.pattern,
+                                       first, last)
+
+        numbers = [n for n in numbers if within >> (n - first) & 1]
+        return _bitmap(search.select(context.mailbox, self.pattern,
+                                     numbers), first)
+
+
+class FullText(Query):
+    """The full-text index of the mail client finds pattern; the index
+    changes on its own, so the result is not cacheable"""
+
+    cost = HEADERCOST
+    cacheable = False
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+
+    def key(self):
+        return ('fts', self.pattern)
+
+    def evaluate(self, context, first, last, within):
+        numbers = context.memo(self, context.fulltext, self.pattern)
+        if numbers is None:
+            # Mailbox not indexed: scan it instead
+            return Text(self.pattern).evaluate(context, first, last, within)
+        return _bitmap(numbers[bisect.bisect_left(numbers, first):
+                               bisect.bisect_left(numbers, last)], first)
+
+
+class Header(Query):
+    """Text column of the header store contains pattern, ignoring case"""
+
+    cost = HEADERCOST
+    headers = True
+
+    def __init__(self, column, pattern):
+        self.column = column
+        self.pattern = pattern.lower()
+
+    def key(self):
+        return ('header', self.column, self.pattern)
+
+    def evaluate(self, context, first, last, within):
+        column = getattr(context.store, self.column)
+        pattern = self.pattern
+        return _bitmap([n for n in _members(within, first, last)
+                        if pattern in column[n].lower()], first)
+
+
+class Date(Query):
+    """Sent from start (included) to stop (excluded), in seconds since
+    the epoch in the sender's timezone"""
+
+    cost = COLUMNCOST
+    headers = True
+
+    def __init__(self, start, stop):
+        self.start = start
+        self.stop = stop
+
+    def key(self):
+        return ('date', self.start, self.stop)
+
+    def evaluate(self, context, first, last, within):
+        if context.store.isfilled():
+            # Binary searches in the date index, once for every range
+            numbers = context.memo(self, context.store.select_dates,
+                                   self.start, self.stop)
+            return _bitmap(numbers[bisect.bisect_left(numbers, first):
+                                   bisect.bisect_left(numbers, last)],
+                           first)
+
+        dates, offsets = context.store.dates, context.store.tzoffsets
+        return _bitmap([n for n in _members(within, first, last)
+                        if self.start <= dates[n] + offsets[n] < self.stop],
+                       first)
+
+
+class Size(Query):
+    """Size from least (included) to most (excluded) bytes"""
+
+    cost = COLUMNCOST
+    headers = True
+
+    def __init__(self, least, most):
+        self.least = least
+        self.most = most
+
+    def key(self):
+        return ('size', self.least, self.most)
+
+    def evaluate(self, context, first, last, within):
+        sizes = context.store.sizes
+        return _bitmap([n for n in _members(within, first, last)
+                        if self.least <= sizes[n] < self.most], first)
+
+
+class Flag(Query):
+    """Flags column has flag set"""
+
+    cost = COLUMNCOST
+    headers = True
+
+    def __init__(self, flag):
+        self.flag = flag
+
+    def key(self):
+        return ('flag', self.flag)
+
+    def evaluate(self, context, first, last, within):
+        flags = context.store.flags
+        return _bitmap([n for n in _members(within, first, last)
+                        if flags[n] & self.flag], first)
+
+
+# =================================================================
+
+
+def compile(text):
+    """compile(text) -> Query
+
+    Compile a query string into a plan. Raise QueryError if the query is
+    not valid.
+    """
+    words = text.split()
+    if not words:
+        raise QueryError('Empty query')
+
+    legacy = FIELDS.get(words[0].lower())
+    if legacy in ('from', 'subject', 'date') and len(words) > 1:
+        return _legacy(legacy, words[1:])
+
+    tokens = _tokenize(text)
+    if not any(_issyntax(token) for token in tokens):
+        return Text(text)  # Plain phrase
+
+    parser = _Parser(tokens)
+    query = parser.parse()
+    if parser.tokens:
+        raise QueryError('Unexpected ' + parser.tokens[0])
+    return query
+
+
+def narrows(old, new):
+    """narrows(old, new) -> Bool
+
+    Return True if every message matching query string new matches query
+    string old, that is if new only lengthens the terms of old or adds
+    terms to them. The result of old can then be refined with new instead
+    of searching the whole mailbox again.
+    """
+    try:
+        old, new = compile(old), compile(new)
+    except QueryError:
+        return False
+
+    terms = _operands(new)
+    return all(any(_implies(term, other) for term in terms)
+               for other in _operands(old))
+
+
+def run(query, mailbox, store, textindex=None, numbers=None, start=0,
+        blocks=None, fts=None):
+    """run(query, mailbox, store, textindex=None, numbers=None, start=0,
+    blocks=None, fts=None) -> iterator
+
+    Run a plan over the messages of a mailbox from number start on; the
+    header columns are in store. Yield (done, numbers) pairs, where
+    numbers are the messages matching the query before message number
+    done (see search.Search). If textindex is built it narrows the
+    full-text terms down; otherwise the block filter blocks (see
+    textindex.BlockFilter), if any, skips the blocks of messages that
+    cannot match them. The fts: terms search fts (see gloda.GlodaIndex),
+    if any.
+
+    If numbers is given, only those messages (in ascending order) are
+    tested, to refine the result of a previous search, and done counts
+    the numbers tested instead.
+
+    """
+    context = _Context(mailbox, store, textindex, blocks, fts)
+
+    if numbers is not None:
+        for chunk in _refine(query, context, numbers):
+            yield chunk
+        context.update()
+        return
+
+    if isinstance(query, Text):
+        # Plain full-text search: parallel over big mailboxes
+        numbers = context.candidates(query.pattern)
+        if numbers is None:
+            count = len(mailbox)
+            spans = context.ranges(query.pattern)
+            if spans is None:
+                spans = [(start, count)]
+            for first, last in spans:
+                for chunk in search.ifind(mailbox, query.pattern,
+                                          max(first, start), last):
+                    yield chunk
+            if not spans or spans[-1][1] < count:
+                yield count, []
+            context.update()
+            return
+        numbers = numbers[bisect.bisect_left(numbers, start):]
+        for i in range(0, len(numbers), search.BATCHSIZE):
+            batch = numbers[i:i + search.BATCHSIZE]
+            yield (batch[-1] + 1,
+                   search.select(mailbox, query.pattern, batch))
+        return
+
+    if query.headers:
+        ranges = store.ifill()  # Evaluate the rows as they are loaded
+    else:
+        ranges = _ranges(start, len(mailbox))
+
+    first = start
+    for last in ranges:
+        if last > first:
+            within = (1 << (last - first)) - 1
+            yield last, _numbers(query.evaluate(context, first, last,
+                                                within), first)
+            first = last
+    context.update()
+
+
+# =================================================================
+
+
+class _Context(object):
+    """Where the terms of a plan are evaluated"""
+
+    def __init__(self, mailbox, store, textindex, blocks=None, fts=None):
+        self.mailbox = mailbox
+        self.store = store
+        self._textindex = textindex
+        self._blocks = blocks
+        self._fts = fts
+        self._candidates = {}
+        self._ranges = {}
+        self._memo = {}
+
+        if textindex is not None and textindex.isbuilt():
+            textindex.update()  # Index new mail
+            self._blocks = None  # Narrower
+        else:
+            self._textindex = None
+
+    def candidates(self, pattern):
+        """Messages that may contain pattern, None if any may"""
+        if self._textindex is None:
+            return None
+        if pattern not in self._candidates:
+            self._candidates[pattern] = self._textindex.candidates(pattern)
+        return self._candidates[pattern]
+
+    def ranges(self, pattern):
+        """Ranges of messages that may contain pattern, None if any may"""
+        if self._blocks is None:
+            return None
+        if pattern not in self._ranges:
+            self._ranges[pattern] = self._blocks.ranges(pattern)
+        return self._ranges[pattern]
+
+    def fulltext(self, pattern):
+        """Messages the full-text index finds with pattern, None without
+        an index of the mailbox"""
+        if self._fts is None:
+            return None
+        return self._fts.search(self.mailbox, pattern)
+
+    def update(self):
+        """Extend the block filter to new mail once a search is complete,
+        in the background, so that it never delays the results nor the
+        end of the search"""
+        if self._blocks is not None and self._ranges:
+            self._blocks.start_update()
+
+    def memo(self, term, func, *args):
+        """Result of func(*args) for term, computed once per query run"""
+        if term not in self._memo:
+            self._memo[term] = func(*args)
+        return self._memo[term]
+
+
+def _refine(query, context, numbers):
+    """Run a plan over the given messages only"""
+    done = 0
+    for count in _ranges(0, len(numbers)):
+        batch = numbers[done:count]
+        if query.headers:
+            for n in batch:
+                context.store.load(n, n + 1)
+        first, last = batch[0], batch[-1] + 1
+        within = _bitmap(batch, first)
+        yield count, _numbers(query.evaluate(context, first, last, within) &
+                              within, first)
+        done = count
+
+
+class _Parser(object):
+    """Recursive descent parser of the query tokens
+
+    query := and ('OR' and)*
+    and := not (['AND'] not)*
+    not := ('NOT' | '-') not | '(' query ')' | term
+
+    """
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+
+    def parse(self):
+        operands = [self._and()]
+        while self._accept('OR'):
+            operands.append(self._and())
+        return operands[0] if len(operands) == 1 else Or(operands)
+
+    def _and(self):
+        operands = [self._not()]
+        while self.tokens and self.tokens[0] not in ('OR', ')'):
+            self._accept('AND')
+            operands.append(self._not())
+        return operands[0] if len(operands) == 1 else And(operands)
+
+    def _not(self):
+        if not self.tokens:
+            raise QueryError('Incomplete query')
+
+        token = self.tokens.pop(0)
+        if token == 'NOT':
+            return Not(self._not())
+        elif token.startswith('-') and len(token) > 1:
+            self.tokens.insert(0, token[1:])
+            return Not(self._not())
+        elif token == '(':
+            query = self.parse()
+            if not self._accept(')'):
+                raise QueryError('Missing )')
+            return query
+        elif token in ('AND', 'OR', ')'):
+            raise QueryError('Unexpected ' + token)
+        return _term(token)
+
+    def _accept(self, token):
+        if self.tokens and self.tokens[0] == token:
+            self.tokens.pop(0)
+            return True
+        return False
+
+
+def _operands(query):
+    """Terms ANDed in a plan"""
+    return query.operands if isinstance(query, And) else [query]
+
+
+def _implies(term, other):
+    """Return True if the messages matching term all match other"""
+    if type(term) is not type(other):
+        return False
+    elif isinstance(term, Text):
+        return other.pattern in term.pattern
+    elif isinstance(term, FullText):
+        return other.pattern == term.pattern  # Words, not substrings
+    elif isinstance(term, Header):
+        return term.column == other.column and other.pattern in term.pattern
+    elif isinstance(term, Date):
+        return other.start <= term.start and term.stop <= other.stop
+    elif isinstance(term, Size):
+        return other.least <= term.least and term.most <= other.most
+    elif isinstance(term, Flag):
+        return term.flag == other.flag
+    return False
+
+
+def _legacy(field, words):
+    """Plan of a search with an old keyword prefix"""
+    if field != 'date':
+        return Header(_column(field), ' '.join(words))
+
+    if len(words) > 1:
+        last = _day(words[1])[1]
+    else:
+        last = calendar.timegm(time.localtime())
+        last = last - last % _DAY + _DAY
+    first = _day(words[0])[0]
+    return Date(min(first, last - _DAY), max(first + _DAY, last))
+
+
+def _tokenize(text):
+    """Split a query into parentheses, (quoted) terms and operators"""
+    return [''.join(match.groups('')) for match in _TOKEN.finditer(text)
+            if match.group().strip()]
+
+
+def _issyntax(token):
+    """Return True if token is not plain text"""
+    return (token in ('(', ')', 'AND', 'OR', 'NOT') or
+            token.startswith('"') or
+            (token.startswith('-') and len(token) > 1) or
+            token.split(':', 1)[0].lower() in FIELDS and ':' in token)
+
+
+def _term(token):
+    """Plan of a single term"""
+    field, colon, value = token.partition(':')
+    field = FIELDS.get(field.lower())
+    if not colon or field is None:
+        return Text(_unquote(token))
+
+    value = _unquote(value)
+    if not value:
+        raise QueryError('Missing value in ' + token)
+
+    if field in ('from', 'subject'):
+        return Header(_column(field), value)
+    elif field == 'date':
+        return Date(*_dates(value))
+    elif field == 'size':
+        return Size(*_sizes(value))
+    elif field == 'fts':
+        return FullText(value)
+    elif value.lower() in ('attachment', 'attachments'):
+        return Flag(store.FLAG_ATTACHMENT)
+    raise QueryError('Unknown has:' + value)
+
+
+def _column(field):
+    """Header store column of a field"""
+    return {'from': 'senders', 'subject': 'subjects'}[field]
+
+
+def _unquote(text):
+    """Text without its quotes; the closing one is optional"""
+    if text.startswith('"'):
+        text = text[1:]
+        if text.endswith('"'):
+            text = text[:-1]
+    return text
+
+
+def _dates(value):
+    """Seconds since the epoch from and to the days of a date term"""
+    if '..' not in value:
+        return _day(value)
+
+    first, last = value.split('..', 1)
+    return (_day(first)[0] if first else -(2 ** 61),
+            _day(last)[1] if last else 2 ** 61)
+
+
+def _day(value):
+    """First and last + 1 seconds of the period of a date"""
+    for fmt, unit in (('%d/%m/%Y', 'day'), ('%Y-%m-%d', 'day'),
+                      ('%Y-%m', 'month'), ('%Y', 'year')):
+        try:
+            tm = time.strptime(value, fmt)
+        except ValueError:
+            continue
+        first = calendar.timegm(tm)
+        if unit == 'day':
+            return first, first + _DAY
+        elif unit == 'month':
+            year, month = divmod(tm.tm_mon, 12)
+            return first, calendar.timegm((tm.tm_year + year, month + 1, 1,
+                                           0, 0, 0))
+        return first, calendar.timegm((tm.tm_year + 1, 1, 1, 0, 0, 0))
+    raise QueryError('Invalid date ' + value)
+
+
+def _sizes(value):
+    """Least and most + 1 bytes of a size term"""
+    if value.startswith('>'):
+        return _size(value[1:]) + 1, 2 ** 62
+    elif value.startswith('<'):
+        return 0, _size(value[1:])
+    elif '..' in value:
+        least, most = value.split('..', 1)
+        return (_size(least) if least else 0,
+                _size(most) + 1 if most else 2 ** 62)
+    return _size(value), 2 ** 62
+
+
+def _size(value):
+    match = re.match(r'(\d+(?:\.\d+)?)([kmg]?)b?$', value.lower())
+    if match is None:
+        raise QueryError('Invalid size ' + value)
+    return int(float(match.group(1)) * _UNITS[match.group(2)])
+
+
+def _ranges(first, count):
+    """Ends of growing ranges of messages, for quick partial results"""
+    last, step = first, 256
+    while last < count:
+        last = min(last + step, count)
+        step = min(2 * step, RANGESIZE)
+        yield last
+
+
+def _members(within, first, last):
+    """Numbers to test to answer for the messages in within: those of
+    within when they are few, the whole range otherwise"""
+    if _count(within) * 8 < last - first:
+        return _numbers(within, first)
+    return range(first, last)
+
+
+def _spans(ranges, first, last):
+    """Bitmap of the messages from first to last - 1 in ranges, all of
+    them if ranges is None"""
+    if ranges is None:
+        return (1 << (last - first)) - 1
+
+    bitmap = 0
+    i = max(bisect.bisect_right(ranges, (first, first)) - 1, 0)
+    for a, b in ranges[i:]:
+        a, b = max(a, first), min(b, last)
+        if a >= last:
+            break
+        if a < b:
+            bitmap |= ((1 << (b - a)) - 1) << (a - first)
+    return bitmap
+
+
+def _count(bitmap):
+    """Number of bits set"""
+    return bin(bitmap).count('1')
+
+
+def _bitmap(numbers, first):
+    """Bitmap of numbers, bit i standing for number first + i"""
+    if not numbers:
+        return 0
+    bits = bytearray((max(numbers) - first) // 8 + 1)
+    for n in numbers:
+        bits[(n - first) >> 3] |= 1 << ((n - first) & 7)
+    bits.reverse()
+    return int(binascii.hexlify(bytes(bits)), 16)
+
+
+def _numbers(bitmap, first):
+    """Ascending numbers of the bits set in bitmap"""
+    if not bitmap:
+        return []
+    digits = '%x' % bitmap
+    bits = bytearray(binascii.unhexlify('0' * (len(digits) % 2) + digits))
+    bits.reverse()
+    return [first + 8 * i + j for i, byte in enumerate(bits) if byte
+            for j in range(8) if byte >> j & 1]
+
+
+# =================================================================
+# Testing procedures.
+# Execute this module (python -m bluebird.query) to perform unit testing.
+# =================================================================
+
+if __name__ == '__main__':
+    import unittest
+    import email
+
+    MESSAGE = ('Date: %s\n'
+               'From: %s\n'
+               'Subject: %s\n'
+               'Content-Type: %s\n'
+               '\n'
+               '%s\n')
+
+    class CountingList(list):
+        """Mailbox counting the messages parsed for their body"""
+
+        read = []
+
+        def __getitem__(self, n):
+            self.read.append(n)
+            return list.__getitem__(self, n)
+
+    class TestQuery(unittest.TestCase):
+
+        def setUp(self):
+            self._mailbox = CountingList(
+                email.message_from_string(MESSAGE % fields) for fields in (
+                    ('Sat, 05 Jan 2013 10:00:00 +0000', 'Bob <bob@x>',
+                     'Invoice 1', 'text/plain', 'Please pay'),
+                    ('Sun, 06 Jan 2013 10:00:00 +0000', 'Alice <alice@x>',
+                     'Lunch', 'multipart/mixed', 'See the invoice'),
+                    ('Mon, 07 Jan 2014 10:00:00 +0000', 'Bob <bob@x>',
+                     'Invoice 2', 'text/plain', 'Nothing here')))
+            self._store = store.HeaderStore(self._mailbox)
+            self._store.fill()
+            self._mailbox.read = []
+
+        def find(self, text):
+            result = []
+            for done, numbers in run(compile(text), self._mailbox,
+                                     self._store):
+                result.extend(numbers)
+            return result
+
+        def test_bitmap(self):
+            numbers = [3, 4, 17, 200]
+            self.assertEqual(_numbers(_bitmap(numbers, 2), 2), numbers)
+            self.assertEqual(_bitmap([], 0), 0)
+            self.assertEqual(_numbers(0, 0), [])
+
+        def test_parse(self):
+            query = compile('pay OR from:alice subject:lunch')
+            self.assertIsInstance(query, Or)
+            self.assertIsInstance(query.operands[0], And)  # Cheapest first
+            self.assertIsInstance(compile('hello there'), Text)
+            self.assertEqual(compile('re: hello').pattern, 're: hello')
+            for text in ('(from:bob', 'OR', 'date:junk', 'size:>x',
+                         'has:wings', 'from:bob )'):
+                self.assertRaises(QueryError, compile, text)
+
+        def test_fields(self):
+            self.assertEqual(self.find('from:BOB'), [0, 2])
+            self.assertEqual(self.find('from:bob subject:invoice '
+                                       'date:2013'), [0])
+            self.assertEqual(self._mailbox.read, [])  # No body read
+            self.assertEqual(self.find('date:2013-01-06..2014'), [1, 2])
+            self.assertEqual(self.find('has:attachment'), [1])
+            self.assertEqual(self.find('-has:attachment size:<1k'), [0, 2])
+            self.assertEqual(self.find('(from:alice OR subject:"invoice 2")'
+                                       ' NOT date:2014'), [1])
+
+        def test_text(self):
+            self.assertEqual(self.find('pay'), [0])
+            self.assertEqual(self.find('from:bob Invoice'), [0, 2])
+            self._mailbox.read = []
+            self.assertEqual(self.find('from:alice invoice'), [1])
+            self.assertEqual(self._mailbox.read, [1])  # Only alice's read
+            self.assertEqual(self.find('from:bob "Please pay"'), [0])
+            self.assertEqual(self.find('Nothing OR lunch'), [2])
+
+        def test_legacy(self):
+            self.assertEqual(self.find('from bob'), [0, 2])
+            self.assertEqual(self.find('s invoice 2'), [2])
+            self.assertEqual(self.find('d 06/01/2013 07/01/2014'), [1, 2])
+            self.assertEqual(self.find('See the'), [1])
+
+        def test_key(self):
+            self.assertEqual(compile('from:Bob  s:"x"').key(),
+                             compile('subject:x AND from:bob').key())
+            self.assertNotEqual(compile('from:bob OR x').key(),
+                                compile('from:bob x').key())
+
+        def test_narrows(self):
+            self.assertTrue(narrows('invo', 'invoice'))
+            self.assertTrue(narrows('from:bo', 'from:bob'))
+            self.assertTrue(narrows('from:bob', 'from:bob subject:x'))
+            self.assertTrue(narrows('date:2013', 'date:2013-01 from:bob'))
+            self.assertFalse(narrows('from:bob', 'from:bob OR x'))
+            self.assertFalse(narrows('from', 'from bob'))
+            self.assertFalse(narrows('Invo', 'invoice'))
+            self.assertFalse(narrows('from:bob', 'from:bob ('))
+
+        def test_fulltext(self):
+            class Index(object):
+                def search(self, mailbox, pattern):
+                    return {'pay': [0, 2]}.get(pattern)
+
+            def find(text, fts):
+                return [n for done, numbers in run(
+                    compile(text), self._mailbox, self._store, fts=fts)
+                    for n in numbers]
+
+            self._mailbox.read = []
+            self.assertEqual(find('fts:pay', Index()), [0, 2])
+            self.assertEqual(find('fts:pay -from:bob', Index()), [])
+            self.assertEqual(self._mailbox.read, [])  # Index only
+            self.assertEqual(find('fts:pay', None), [0])  # Scanned
+            self.assertEqual(find('fts:invoice', Index()), [1])
+            self.assertFalse(compile('fts:pay from:bob').cacheable)
+            self.assertTrue(compile('pay from:bob').cacheable)
+            self.assertFalse(narrows('fts:pa', 'fts:pay'))
+
+        def test_refine(self):
+            self._mailbox.read = []
+            chunks = run(compile('from:bob'), self._mailbox, self._store,
+                         numbers=[1, 2])
+            self.assertEqual(list(chunks), [(2, [2])])
+            chunks = run(compile('from:bob'), self._mailbox, self._store,
+                         numbers=[1])
+            self.assertEqual(list(chunks), [(1, [])])
+            chunks = run(compile('Nothing OR pay'), self._mailbox,
+                         self._store, numbers=[0, 1])
+            self.assertEqual(list(chunks), [(2, [0])])
+            self.assertEqual(set(self._mailbox.read), set([0, 1]))
+
+    unittest.main()
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Query result cache
+
+The same searches are run again and again. The results of the last
+queries run on a mailbox are kept in a sidecar file, keyed by the
+canonical form of their plan (see query.Query.key), and the least
+recently used are dropped first, keeping the results stored under
+CACHEBYTES. A result bigger than that is not cached.
+
+Each result records how many messages it covers and a digest of their
+keys (see mbox.Mbox). A query on a mailbox that was appended to only
+searches the new mail and adds its matches to the cached result; a
+result of a mailbox that was rewritten is dropped.
+
+classes:
+
+QueryCache -- Persistent LRU cache of the query results of a mailbox
+
+"""
+import array
+import hashlib
+import collections
+
+from . import cache
+from . import query
+from . import store
+
+### Module Constants ##
+
+# Bump when the layout of the cache changes
+CACHEVERSION = 1
+
+CACHESIZE = 64  # Queries kept per mailbox
+CACHEBYTES = 4 * 1024 * 1024  # Result bytes kept per mailbox
+
+# Array type code of the message numbers; run() has a store argument
+NUMBERTYPE = store.INTTYPE
+
+
+# =================================================================
+
+
+class QueryCache(object):
+    """Persistent LRU cache of the query results of a mailbox
+
+    Only mailboxes with path and keys attributes (see mbox.Mbox) are
+    cached; the queries on other mailboxes are always run.
+
+    """
+
+    _mailbox = None
+    _path = None  # Sidecar file, None if the mailbox is not cached
+    _entries = None  # key -> (count, digest, numbers), most recent last
+    _dirty = False
+
+    def __init__(self, mailbox):
+        self._mailbox = mailbox
+        try:
+            self._path = cache.sidecar_path(mailbox.path, 'qry')
+            mailbox.keys
+        except AttributeError:
+            self._path = None
+
+    def __len__(self):
+        """Number of queries cached"""
+        self._load()
+        return len(self._entries)
+
+    def run(self, plan, store, textindex=None, blocks=None, fts=None):
+        """C.run(plan, store, textindex=None, blocks=None, fts=None)
+        -> iterator
+
+        Like query.run(), answering from the cache. The cached result of
+        plan comes first, then the matches in the mail added since. The
+        result is cached when the run is complete, unless plan is not
+        cacheable (see query.Query).
+        """
+        if self._path is None or not plan.cacheable:
+            for chunk in query.run(plan, self._mailbox, store, textindex,
+                                   blocks=blocks, fts=fts):
+                yield chunk
+            return
+
+        self._load()
+        key = repr(plan.key())
+        count, numbers = 0, array.array(NUMBERTYPE)
+        entry = self._entries.get(key)
+        if entry is not None and entry[1] == self._digest(entry[0]):
+            count, numbers = entry[0], array.array(NUMBERTYPE, entry[2])
+            yield count, numbers.tolist()
+
+        for done, found in query.run(plan, self._mailbox, store, textindex,
+                                     start=count, blocks=blocks, fts=fts):
+            numbers.extend(found)
+            yield done, found
+
+        # Complete: most recently used
+        self._entries.pop(key, None)
+        self._dirty = True
+        if _size(numbers) > CACHEBYTES:
+            return  # Too big to be worth keeping
+
+        self._entries[key] = (len(self._mailbox),
+                              self._digest(len(self._mailbox)), numbers)
+        total = sum(_size(entry[2]) for entry in self._entries.values())
+        while len(self._entries) > CACHESIZE or total > CACHEBYTES:
+            total -= _size(self._entries.popitem(last=False)[1][2])
+
+    def save(self):
+        """C.save() -> void
+
+        Store the cached results for the next session.
+        """
+        if not self._dirty:
+            return
+
+        cache.dump(self._path, {'version': CACHEVERSION,
+                                'entries': self._entries})
+        self._dirty = False
+
+    def _load(self):
+        """Read the stored results the first time they are needed"""
+        if self._entries is not None:
+            return
+
+        self._entries = collections.OrderedDict()
+        if self._path is None:
+            return
+
+        data = cache.load(self._path)
+        if data is not None and data['version'] == CACHEVERSION:
+            self._entries = data['entries']
+
+    def _digest(self, count):
+        """Digest of the keys of the first count messages"""
+        keys = self._mailbox.keys
+        if count > len(keys):
+            return None
+        try:
+            data = keys[:count].tobytes()
+        except AttributeError:
+            data = repr(list(keys[:count])).encode('ascii')
+        return hashlib.sha1(data).digest()
+
+
+# =================================================================
+
+
+def _size(numbers):
+    """Bytes taken by an array of message numbers"""
+    return len(numbers) * numbers.itemsize
+
+
+# =================================================================
+# Testing procedures.
+# Execute this module (python -m bluebird.querycache) to perform unit
+# testing.
+# =================================================================
+
+if __name__ == '__main__':
+    import unittest
+    import email
+    import shutil
+    import tempfile
+
+    MESSAGE = ('From: %s\n'
+               'Subject: %s\n'
+               '\n'
+               'Body\n')
+
+    class Mailbox(list):
+        """Mailbox with the attributes of the cached ones, counting the
+        messages read"""
+
+        path = 'INBOX'
+        keys = None
+        read = []
+
+        def __getitem__(self, n):
+            self.read.append(n)
+            return list.__getitem__(self, n)
+
+    class TestQueryCache(unittest.TestCase):
+
+        def setUp(self):
+            cache.CACHEPATH = tempfile.mkdtemp()
+            self._mailbox = Mailbox(
+                email.message_from_string(MESSAGE % fields)
+                for fields in (('Bob', 'invoice'), ('Alice', 'lunch'),
+                               ('Bob', 'lunch')))
+            self._mailbox.keys = [10, 11, 12]
+
+        def tearDown(self):
+            shutil.rmtree(cache.CACHEPATH)
+
+        def find(self, text, results=None):
+            if results is None:
+                results = QueryCache(self._mailbox)
+            self._mailbox.read = []
+            found = []
+            for done, numbers in results.run(
+                    query.compile(text), store.HeaderStore(self._mailbox)):
+                found.extend(numbers)
+            results.save()
+            return found
+
+        def test_cache(self):
+            self.assertEqual(self.find('lunch'), [1, 2])
+            self.assertEqual(self.find('lunch'), [1, 2])
+            self.assertEqual(self._mailbox.read, [])  # Cached
+
+            # Appended mail: only the new message is searched
+            self._mailbox.append(self._mailbox[0])
+            self._mailbox.keys.append(13)
+            self.assertEqual(self.find('lunch'), [1, 2])
+            self.assertEqual(self._mailbox.read, [3])
+
+            # Rewritten mailbox: searched again
+            del self._mailbox[0]
+            del self._mailbox.keys[0]
+            self.assertEqual(self.find('lunch'), [0, 1])
+            self.assertEqual(sorted(self._mailbox.read), [0, 1, 2])
+
+        def test_lru(self):
+            global CACHESIZE
+            cachesize, CACHESIZE = CACHESIZE, 2
+            try:
+                results = QueryCache(self._mailbox)
+                for text in ('lunch', 'invoice', 'lunch', 'Bob'):
+                    self.find(text, results)
+                self.assertEqual(len(results), 2)
+                self.assertEqual(len(QueryCache(self._mailbox)), 2)
+                self.find('lunch')
+                self.assertEqual(self._mailbox.read, [])  # Kept
+            finally:
+                CACHESIZE = cachesize
+
+        def test_bytes(self):
+            global CACHEBYTES
+            cachebytes, CACHEBYTES = CACHEBYTES, 16
+            try:
+                results = QueryCache(self._mailbox)
+                for text in ('Body', 'lunch', 'invoice'):
+                    self.find(text, results)
+                self.assertEqual(len(results), 1)  # 'Body' too big
+                self.find('invoice')
+                self.assertEqual(self._mailbox.read, [])  # Kept
+                self.find('lunch')
+                self.assertNotEqual(self._mailbox.read, [])  # Dropped
+            finally:
+                CACHEBYTES = cachebytes
+
+    unittest.main()
@@ -0,0 +1,468 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Mailbox search
+
+Free-text searches test the decoded from, subject and body of every
+message, yet almost no message matches. Before parsing anything, the
+raw bytes of the mailbox are searched for the pattern: a message whose
+raw bytes do not contain it can only match if decoding changes its
+text, that is, if it has base64, quoted-printable or uuencoded parts or
+encoded header words (or, for non ASCII patterns, any charset other
+than UTF-8). Only the messages passing this prefilter are parsed.
+
+The raw search runs over the mapped mbox file, one chunk of messages at
+a time, with bytes.find and compiled regular expressions.
+
+Searches over big mbox files are split in ranges of messages searched
+by worker processes, each opening the mbox on its own.
+
+Results are produced range by range, so a search can run in a
+background thread while the first matches are already displayed.
+
+classes:
+
+Search -- Search running in a background thread
+
+functions:
+
+find -- Numbers of the messages matching a free-text pattern
+ifind -- Iterator over the matches of a free-text pattern, range by range
+matches -- Test whether a message matches a free-text pattern
+prefilter -- Numbers of the messages that may contain a pattern
+select -- Numbers of the given messages matching a free-text pattern
+
+"""
+import re
+import bisect
+import threading
+
+from . import mbox
+from . import parallel
+from . import utils
+
+### Module Constants ##
+
+CHUNKSIZE = 16 * 1024 * 1024  # Bytes searched at once
+
+SHARDSIZE = 64 * 1024 * 1024  # Minimum bytes searched by a worker process
+
+BATCHSIZE = 64  # Messages parsed between two partial results
+
+# Message content that may hide a pattern until decoded: OPAQUE for
+# ASCII patterns, OPAQUECHARSET for the others
+_ENCODED = (br'^content-transfer-encoding:[ \t]*'
+            br'(?:base64|quoted-printable|x-uuencode|uuencode|x-uue)'
+            br'|=\?[^?\s]+\?[bq]\?')
+OPAQUE = re.compile(_ENCODED, re.I | re.M)
+OPAQUECHARSET = re.compile(_ENCODED +
+                           br'|charset=(?!"?(?:utf-8|us-ascii)\b)',
+                           re.I | re.M)
+
+
+# =================================================================
+
+
+def matches(message, pattern):
+    """matches(message, pattern) -> Bool
+
+    Return True if the from, subject or main content of message contain
+    pattern.
+    """
+    return (pattern in utils.get_header_param(message, 'from') or
+            pattern in utils.get_header_param(message, 'subject') or
+            pattern in utils.get_content_body(message))
+
+
+def find(mailbox, pattern, first=0, last=None):
+    """find(mailbox, pattern, first=0, last=None) -> list
+
+    Return the ascending numbers of the messages from first to last - 1
+    matching pattern. Only the messages passing the prefilter are
+    parsed. Big mbox files are searched by all the cores.
+
+    """
+    result = []
+    for done, numbers in ifind(mailbox, pattern, first, last):
+        result.extend(numbers)
+    return result
+
+
+def ifind(mailbox, pattern, first=0, last=None):
+    """ifind(mailbox, pattern, first=0, last=None) -> iterator
+
+    Like find(), but search the mailbox range by range, in order. Yield
+    (done, numbers) pairs, where numbers are the messages matching
+    pattern before message number done. Closing the iterator stops the
+    search.
+
+    """
+    if last is None:
+        last = len(mailbox)
+    if first >= last:
+        return
+
+    try:
+        path = mailbox.path
+        starts, stops = mailbox.toc
+    except AttributeError:
+        for chunk in _stream(mailbox, pattern, [first, last]):
+            yield chunk
+        return
+
+    # Ranges of messages of about the same size, several per worker to
+    # even out the load
+    size = stops[last - 1] - starts[first]
+    shards = min(4 * parallel.WORKERS, size // SHARDSIZE)
+    if parallel.WORKERS < 2 or shards < 2:
+        # Small ranges first for quick partial results, then whole chunks
+        limits, step = [first], CHUNKSIZE // 256
+        while limits[-1] < last:
+            n = limits[-1]
+            m = bisect.bisect_left(starts, starts[n] + step, n, last)
+            limits.append(max(m, n + 1))
+            step = min(2 * step, CHUNKSIZE)
+        for chunk in _stream(mailbox, pattern, limits):
+            yield chunk
+        return
+
+    limits = [first]
+    for i in range(1, shards):
+        n = bisect.bisect_left(starts, starts[first] + i * size // shards,
+                               first, last)
+        if limits[-1] < n < last:
+            limits.append(n)
+    limits.append(last)
+
+    tasks = [(path, a, starts[a:b], stops[a:b], pattern)
+             for a, b in zip(limits[:-1], limits[1:])]
+    for done, numbers in zip(limits[1:], parallel.imap(_find_shard, tasks)):
+        yield done, numbers
+
+
+def select(mailbox, pattern, numbers):
+    """select(mailbox, pattern, numbers) -> list
+
+    Return the messages of numbers matching pattern. Their raw bytes are
+    checked before parsing them when the mailbox gives access to them.
+    """
+    needle, opaque = _needle(pattern)
+    try:
+        get_bytes = mailbox.get_bytes
+    except AttributeError:
+        pass
+    else:
+        numbers = [n for n in numbers
+                   if _maymatch_raw(get_bytes, n, needle, opaque)]
+    return [n for n in numbers if _matches(mailbox, n, pattern)]
+
+
+def _stream(mailbox, pattern, limits):
+    """Search the ranges of messages between limits in this process
+
+    The candidates of each range are parsed a few at a time, so the first
+    matches come out quickly.
+
+    """
+    for first, last in zip(limits[:-1], limits[1:]):
+        numbers = prefilter(mailbox, pattern, first, last)
+        for i in range(0, len(numbers), BATCHSIZE):
+            batch = numbers[i:i + BATCHSIZE]
+            if i + BATCHSIZE < len(numbers):
+                done = numbers[i + BATCHSIZE]
+            else:
+                done = last
+            yield done, [n for n in batch if _matches(mailbox, n, pattern)]
+        if not numbers:
+            yield last, []
+
+
+def _find(mailbox, pattern, first, last):
+    """Search the messages from first to last - 1 in this process"""
+    return [n for n in prefilter(mailbox, pattern, first, last)
+            if _matches(mailbox, n, pattern)]
+
+
+def _matches(mailbox, number, pattern):
+    """matches() for message number of mailbox, False if it was removed
+    since the mailbox was opened (see maildir.Maildir)"""
+    try:
+        message = mailbox[number]
+    except KeyError:
+        return False
+    return matches(message, pattern)
+
+
+def _maymatch_raw(get_bytes, number, needle, opaque):
+    """_maymatch() for the raw bytes of message number, False if it was
+    removed since the mailbox was opened"""
+    try:
+        data = bytes(get_bytes(number))
+    except KeyError:
+        return False
+    return _maymatch(data, needle, opaque)
+
+
+def _find_shard(task):
+    """Search a range of messages of an mbox in a worker process"""
+    path, first, starts, stops, pattern = task
+    mailbox = mbox.Mbox(path, toc=(starts, stops))
+    try:
+        return [first + n for n in _find(mailbox, pattern, 0, len(mailbox))]
+    finally:
+        mailbox.close()
+
+
+class Search(object):
+    """Search running in a background thread
+
+    The search consumes an iterator of (done, numbers) pairs such as
+    ifind() returns, where done counts up to total. The numbers found are
+    appended to results as soon as each pair is produced; the list can
+    be read while the search runs.
+
+    """
+
+    _chunks = None
+    _cancelled = None
+    _thread = None
+
+    results = None
+    done = 0
+    total = 0
+    finished = False  # Searched through, not cancelled
+
+    def __init__(self, chunks, total):
+        self._chunks = chunks
+        self._cancelled = threading.Event()
+        self.results = []
+        self.total = total
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        try:
+            for done, numbers in self._chunks:
+                if self._cancelled.is_set():
+                    break
+                self.results.extend(numbers)
+                self.done = done
+            else:
+                self.finished = True
+        finally:
+            if hasattr(self._chunks, 'close'):
+                self._chunks.close()  # Stop the worker processes
+            self.done = self.total
+
+    @property
+    def progress(self):
+        """Fraction of the mailbox searched, from 0 to 1"""
+        if self.total == 0:
+            return 1.0
+        return min(float(self.done) / self.total, 1.0)
+
+    def isrunning(self):
+        """S.isrunning() -> Bool
+
+        Return True until the search is finished or cancelled.
+        """
+        return self._thread.is_alive()
+
+    def cancel(self, wait=True):
+        """S.cancel(wait=True) -> void
+
+        Stop the search, and wait for it unless wait is False. The results
+        found so far are kept.
+        """
+        self._cancelled.set()
+        if wait:
+            self._thread.join()
+
+    def wait(self):
+        """S.wait() -> list
+
+        Wait for the search to finish and return its results.
+        """
+        self._thread.join()
+        return self.results
+
+
+def prefilter(mailbox, pattern, first=0, last=None):
+    """prefilter(mailbox, pattern, first=0, last=None) -> list
+
+    Return the ascending numbers of the messages from first to last - 1
+    that may contain pattern once decoded. The result is a superset of
+    the matches: every candidate must still be checked.
+
+    Mailboxes without raw access (see mbox.Mbox) return every message.
+
+    """
+    if last is None:
+        last = len(mailbox)
+
+    needle, opaque = _needle(pattern)
+
+    try:
+        data = mailbox.data
+        starts, stops = mailbox.toc
+    except AttributeError:
+        pass
+    else:
+        return _prefilter_mbox(data, starts, stops, needle, opaque,
+                               first, last)
+
+    try:
+        get_bytes = mailbox.get_bytes
+    except AttributeError:
+        return list(range(first, last))
+    return [n for n in range(first, last)
+            if _maymatch_raw(get_bytes, n, needle, opaque)]
+
+
+def _prefilter_mbox(data, starts, stops, needle, opaque, first, last):
+    """Prefilter the messages of a mapped mbox file"""
+    result = []
+    n = first
+    while n < last:
+        # Chunk of whole messages: matches never cross a chunk limit
+        m = bisect.bisect_left(starts, starts[n] + CHUNKSIZE, n, last)
+        m = max(m, n + 1)
+        end = stops[m - 1]
+
+        found = set()
+        for search in (lambda pos: data.find(needle, pos, end),
+                       lambda pos: _search(opaque, data, pos, end)):
+            pos = search(starts[n])
+            while pos >= 0:
+                k = bisect.bisect_right(starts, pos, n, m) - 1
+                found.add(k)
+                pos = search(max(stops[k], pos + 1))  # Next message
+        result.extend(sorted(found))
+        n = m
+
+    return result
+
+
+def _needle(pattern):
+    """Return the raw pattern and the regex of content hiding it"""
+    needle = pattern.encode('utf-8')
+    if needle == pattern.encode('ascii', 'replace'):
+        return needle, OPAQUE
+    return needle, OPAQUECHARSET  # Other charsets encode it differently
+
+
+def _search(regex, data, pos, end):
+    """Return the position of the first match of regex in data or -1"""
+    match = regex.search(data, pos, end)
+    return -1 if match is None else match.start()
+
+
+def _maymatch(raw, needle, opaque):
+    """Return True if the raw message may contain needle once decoded"""
+    return needle in raw or opaque.search(raw) is not None
+
+
+# =================================================================
+# Testing procedures.
+# Execute this module (python -m bluebird.search) to perform unit testing.
+# =================================================================
+
+if __name__ == '__main__':
+    import sys
+    import shutil
+    import tempfile
+    import unittest
+
+    from . import cache
+
+    MESSAGES = (
+        'Subject: plain\n\nThe needle is here\n',
+        'Subject: other\n\nNothing to see\n',
+        'Subject: =?utf-8?q?encoded?=\n\nNothing to see\n',
+        'Subject: qp\nContent-Transfer-Encoding: quoted-printable\n\n'
+        'The nee=\ndle\n',
+        'Subject: latin\nContent-Type: text/plain; charset=iso-8859-1\n\n'
+        'Nothing to see\n',
+    )
+
+    class TestPrefilter(unittest.TestCase):
+
+        def setUp(self):
+            self._dir = tempfile.mkdtemp()
+            cache.CACHEPATH = self._dir
+            with open(self._dir + '/INBOX', 'w') as f:
+                for message in MESSAGES:
+                    f.write('From - Sat Jan 01 00:00:00 2013\n' + message +
+                            '\n')
+            self._mailbox = mbox.Mbox(self._dir + '/INBOX')
+
+        def tearDown(self):
+            self._mailbox.close()
+            shutil.rmtree(self._dir)
+
+        def test_prefilter(self):
+            self.assertEqual(prefilter(self._mailbox, 'needle'), [0, 2, 3])
+            self.assertEqual(prefilter(self._mailbox, 'needle', 1, 3), [2])
+            self.assertEqual(prefilter(self._mailbox, 'n\xe9edle'),
+                             [2, 3, 4])
+
+        def test_chunks(self):
+            global CHUNKSIZE
+            chunksize, CHUNKSIZE = CHUNKSIZE, 1
+            try:
+                self.assertEqual(prefilter(self._mailbox, 'needle'),
+                                 [0, 2, 3])
+            finally:
+                CHUNKSIZE = chunksize
+
+        def test_find(self):
+            self.assertEqual(find(self._mailbox, 'needle'), [0, 3])
+            self.assertEqual(find(self._mailbox, 'encoded'), [2])
+
+        def test_parallel(self):
+            global SHARDSIZE
+            shardsize, SHARDSIZE = SHARDSIZE, 1
+            workers, parallel.WORKERS = parallel.WORKERS, 4
+            try:
+                self.assertEqual(list(ifind(self._mailbox, 'needle')),
+                                 [(1, [0]), (2, []), (3, []), (4, [3]),
+                                  (5, [])])
+                self.assertEqual(find(self._mailbox, 'needle', 1), [3])
+            finally:
+                SHARDSIZE, parallel.WORKERS = shardsize, workers
+
+        def test_search(self):
+            chunks = ifind(self._mailbox, 'needle')
+            s = Search(chunks, len(self._mailbox))
+            self.assertEqual(s.wait(), [0, 3])
+            self.assertFalse(s.isrunning())
+            self.assertTrue(s.finished)
+            self.assertEqual(s.progress, 1.0)
+
+            def forever():
+                n = 0
+                while True:
+                    yield n + 1, [n]
+                    n += 1
+
+            s = Search(forever(), 10 ** 9)
+            s.cancel()
+            self.assertFalse(s.isrunning())
+            self.assertFalse(s.finished)
+            self.assertEqual(s.results, list(range(len(s.results))))
+
+        def test_select(self):
+            self.assertEqual(select(self._mailbox, 'needle', [1, 2, 3]),
+                             [3])
+
+        def test_generic(self):
+            mailbox = [self._mailbox[n] for n in range(len(self._mailbox))]
+            self.assertEqual(prefilter(mailbox, 'needle'),
+                             list(range(len(MESSAGES))))
+
+    try:
+        assert sys.platform.startswith('linux')
+    except AssertionError:
+        raise AssertionError('Unsupported platform ' + sys.platform)
+    unittest.main()
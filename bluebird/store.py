@@ -0,0 +1,582 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Mailbox header store
+
+Columnar in-memory store of the message headers shown in the inbox
+list and used by searches. Each message is parsed once; its fields are
+kept in parallel columns indexed by message number.
+
+Messages are loaded by pages of PAGESIZE messages as they are asked
+for, so showing any row of the mailbox only parses the page it is in.
+
+The columns of mailboxes giving a key to each message (see mbox.Mbox)
+are stored in a sidecar file for the next session. Messages are matched
+with their cached fields by key, so after Thunderbird compacts a folder
+only the messages that changed are parsed again.
+
+Messages with an entry in the Thunderbird summary of the mailbox (see
+mbox.Mbox.summary) are not parsed at all: their columns are copied from
+it. The summary gives no timezone (the offset is 0) and its attachment
+flag is Thunderbird's own.
+
+Date searches use an index of the messages sorted by date, built once
+every message is loaded: a range of dates is two binary searches.
+
+Columns:
+
+dates -- Date header as seconds since the epoch, UTC (NODATE if unknown)
+tzoffsets -- Timezone offset of the Date header in seconds
+senders -- Decoded From header, interned
+subjects -- Decoded Subject header
+sizes -- Message size in bytes
+flags -- Bitmask of FLAG_* values
+
+classes:
+
+HeaderStore -- Header columns of the messages of a mailbox
+
+"""
+import sys
+import array
+import bisect
+import email.utils
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from . import cache
+from . import mbox
+from . import mork
+from . import parallel
+from . import utils
+
+if sys.version_info.major == 3:
+    intern = sys.intern
+
+### Module Constants ##
+
+NODATE = -(2 ** 62)  # Far enough from the int64 limits to add offsets
+
+# Array type code of the 64 bit integer columns
+try:
+    array.array('q')
+    INTTYPE = 'q'
+except ValueError:
+    INTTYPE = 'l'  # Python 2: no 'q', long is 64 bits on Linux
+
+FLAG_ATTACHMENT = 0x01
+
+PAGESIZE = 32  # Messages loaded at once
+
+PARALLELPARSE = 4096  # Messages to parse worth starting worker processes
+
+SUMMARYROWS = 1024  # Messages missing worth reading the summary for
+
+# Bump when the layout of the stored columns changes
+STOREVERSION = 1
+
+# =================================================================
+
+
+class HeaderStore(object):
+    """Header columns of the messages of a mailbox
+
+    The mailbox must support len() and indexing by message number. If it
+    has get_headers() and get_size() methods (see mbox.Mbox) they are
+    used to avoid parsing the whole message. If it has path and keys
+    attributes the columns are cached between sessions.
+
+    """
+
+    _mailbox = None
+    _pages = None  # Loaded flag of each page
+    _rows = None  # Loaded flag of each message
+    _path = None  # Sidecar file, None if the store is not cached
+    _keys = None
+    _dirty = False
+    _dateindex = None  # Sorted local dates and their message numbers
+
+    def __init__(self, mailbox):
+        self._mailbox = mailbox
+
+        count = len(mailbox)
+        self._pages = bytearray((count + PAGESIZE - 1) // PAGESIZE)
+        self._rows = bytearray(count)
+
+        self.dates = array.array(INTTYPE, [NODATE]) * count
+        self.tzoffsets = array.array('i', [0]) * count
+        self.senders = [''] * count
+        self.subjects = [''] * count
+        self.sizes = array.array(INTTYPE, [0]) * count
+        self.flags = array.array('B', [0]) * count
+
+        try:
+            self._path = cache.sidecar_path(mailbox.path, 'hdr')
+            self._keys = mailbox.keys
+        except AttributeError:
+            self._path = None
+        else:
+            self._restore(cache.load(self._path))
+
+        # Reading the summary costs a parse of all of it: not worth it
+        # for a few new messages
+        missing = self._rows.count(b'\x00')
+        if missing and missing >= min(SUMMARYROWS, count):
+            self._summarize(getattr(mailbox, 'summary', None))
+
+    def __len__(self):
+        return len(self._mailbox)
+
+    def load(self, first, last):
+        """S.load(first, last) -> void
+
+        Make sure the headers of messages first to last - 1 are loaded.
+        Only the pages not loaded yet are parsed.
+        """
+        last = min(last, len(self))
+        for page in range(first // PAGESIZE,
+                          (last + PAGESIZE - 1) // PAGESIZE):
+            if self._pages[page]:
+                continue
+            for n in range(page * PAGESIZE,
+                           min((page + 1) * PAGESIZE, len(self))):
+                if not self._rows[n]:
+                    self._parse(n)
+                    self._rows[n] = 1
+                    self._dirty = True
+            self._pages[page] = 1
+
+    def isloaded(self, number):
+        """S.isloaded(number) -> Bool
+
+        Return True if the headers of message number are loaded.
+        """
+        return bool(self._pages[number // PAGESIZE])
+
+    def isfilled(self):
+        """S.isfilled() -> Bool
+
+        Return True if the headers of every message are loaded.
+        """
+        return 0 not in self._pages
+
+    def fill(self):
+        """S.fill() -> void
+
+        Load the headers of every message in the mailbox and cache them.
+        Many messages are parsed in parallel by worker processes, or read
+        in parallel by the mailbox if it can (see maildir.Maildir).
+        """
+        for done in self.ifill():
+            pass
+
+    def ifill(self):
+        """S.ifill() -> iterator
+
+        Like fill(), yielding the number of leading messages loaded as
+        the work progresses.
+        """
+        done = 0
+        if parallel.WORKERS > 1 and hasattr(self._mailbox, 'toc'):
+            missing = [n for n, loaded in enumerate(self._rows)
+                       if not loaded]
+            if len(missing) >= PARALLELPARSE:
+                for done in self._parallel_parse(missing):
+                    yield done
+
+        step = 32 * PAGESIZE
+        for first in range(0, len(self), step):
+            if hasattr(self._mailbox, 'read_headers'):
+                self._mailbox.read_headers(
+                    [n for n in range(first, min(first + step, len(self)))
+                     if not self._rows[n]])
+            self.load(first, first + step)
+            done = max(done, min(first + step, len(self)))
+            yield done
+        self.save()
+
+    def save(self):
+        """S.save() -> void
+
+        Store the loaded columns for the next session, if anything new
+        was loaded.
+        """
+        if self._path is None or not self._dirty:
+            return
+
+        cache.dump(self._path,
+                   {'version': STOREVERSION,
+                    'keys': self._keys,
+                    'rows': self._rows,
+                    'dates': self.dates,
+                    'tzoffsets': self.tzoffsets,
+                    'senders': self.senders,
+                    'subjects': self.subjects,
+                    'sizes': self.sizes,
+                    'flags': self.flags})
+        self._dirty = False
+
+    def select(self, column, pattern, start=0, stop=None):
+        """S.select(column, pattern, start=0, stop=None) -> list
+
+        Return the numbers of the messages from start to stop - 1 whose
+        text column contains pattern.
+        """
+        start, stop = self._range(start, stop)
+        return [n for n in range(start, stop) if pattern in column[n]]
+
+    def select_dates(self, first, last, start=0, stop=None):
+        """S.select_dates(first, last, start=0, stop=None) -> list
+
+        Return the numbers of the messages from start to stop - 1 sent
+        from first (included) to last (excluded). Both are given in
+        seconds since the epoch and compared with the date in the
+        sender's timezone.
+        """
+        start, stop = self._range(start, stop)
+        if start == 0 and stop == len(self):
+            dates, numbers = self._sorted_dates()
+            return sorted(numbers[bisect.bisect_left(dates, first):
+                                  bisect.bisect_left(dates, last)])
+
+        if numpy is not None:
+            local = self._local_dates()[start:stop]
+            return (numpy.flatnonzero((local >= first) & (local < last)) +
+                    start).tolist()
+
+        return [n for n in range(start, stop)
+                if first <= self.dates[n] + self.tzoffsets[n] < last]
+
+    def _local_dates(self):
+        """Return the numpy array of the dates in the sender's timezone"""
+        return (numpy.frombuffer(self.dates,
+                                 dtype='i%d' % self.dates.itemsize) +
+                numpy.frombuffer(self.tzoffsets, dtype=numpy.int32))
+
+    def _sorted_dates(self):
+        """Return the local dates in ascending order and the numbers of
+        their messages, sorting them the first time"""
+        if self._dateindex is not None:
+            return self._dateindex
+
+        if numpy is not None:
+            local = self._local_dates()
+            order = numpy.argsort(local, kind='mergesort')
+            # Built from a string, as both Python 2 and 3 allow
+            dtype = 'i%d' % self.dates.itemsize
+            dates = array.array(INTTYPE, local[order].astype(dtype).tobytes())
+            numbers = array.array(INTTYPE, order.astype(dtype).tobytes())
+        else:
+            dates, numbers = array.array(INTTYPE), array.array(INTTYPE)
+            local = [date + offset
+                     for date, offset in zip(self.dates, self.tzoffsets)]
+            numbers.extend(sorted(range(len(local)),
+                                  key=local.__getitem__))
+            dates.extend(local[n] for n in numbers)
+
+        self._dateindex = dates, numbers
+        return self._dateindex
+
+    def _range(self, start, stop):
+        """Load the messages from start to stop - 1 before a selection"""
+        if stop is None:
+            stop = len(self)
+        if start == 0 and stop == len(self):
+            self.fill()
+        else:
+            self.load(start, stop)
+        return start, stop
+
+    def _restore(self, data):
+        """Copy the cached fields of the messages still in the mailbox"""
+        if data is None or data['version'] != STOREVERSION:
+            return
+
+        columns = ('dates', 'tzoffsets', 'senders', 'subjects', 'sizes',
+                   'flags')
+
+        keys = data['keys']
+        if keys == self._keys[:len(keys)]:
+            # Unchanged or appended to: same messages at the same place
+            count = len(keys)
+            for name in columns:
+                getattr(self, name)[:count] = data[name]
+            self._rows[:count] = data['rows']
+        else:
+            # Rewritten: look every message up by key
+            old = dict((key, i) for i, key in enumerate(keys)
+                       if data['rows'][i])
+            for n, key in enumerate(self._keys):
+                i = old.get(key)
+                if i is None:
+                    continue
+                for name in columns:
+                    getattr(self, name)[n] = data[name][i]
+                self._rows[n] = 1
+            self._dirty = True
+
+        self._update_pages()
+
+    def _summarize(self, entries):
+        """Copy the fields of the messages not loaded from their
+        Thunderbird summary entries, if any"""
+        if not entries:
+            return
+
+        for n, entry in entries.items():
+            offset, size, date, flags, sender, subject, key = entry
+            if self._rows[n]:
+                continue
+            self._set(n, (NODATE if date is None else date, 0, sender,
+                          subject, self._mailbox.get_size(n),
+                          FLAG_ATTACHMENT
+                          if flags & mork.MSG_FLAG_ATTACHMENT else 0))
+            self._rows[n] = 1
+            self._dirty = True
+
+        self._update_pages()
+
+    def _update_pages(self):
+        """Flag the pages whose messages are all loaded"""
+        for page in range(len(self._pages)):
+            if b'\x00' not in self._rows[page * PAGESIZE:
+                                         (page + 1) * PAGESIZE]:
+                self._pages[page] = 1
+
+    def _parse(self, number):
+        """Parse message number and store its fields in the columns"""
+        self._set(number, _fields(self._mailbox, number))
+
+    def _set(self, number, fields):
+        """Store the fields of message number in the columns"""
+        (self.dates[number], self.tzoffsets[number], sender,
+         self.subjects[number], self.sizes[number],
+         self.flags[number]) = fields
+        self.senders[number] = intern(sender)
+        self._dateindex = None
+
+    def _parallel_parse(self, numbers):
+        """Parse the messages in numbers in worker processes
+
+        Yield the number of leading messages parsed after each chunk.
+        """
+        starts, stops = self._mailbox.toc
+        size = -(-len(numbers) // (4 * parallel.WORKERS))  # Ceil division
+        chunks = [numbers[i:i + size] for i in range(0, len(numbers), size)]
+        tasks = [(self._mailbox.path,
+                  array.array(mbox.TOCTYPE, [starts[n] for n in chunk]),
+                  array.array(mbox.TOCTYPE, [stops[n] for n in chunk]))
+                 for chunk in chunks]
+
+        for chunk, result in zip(chunks, parallel.imap(_parse_shard, tasks)):
+            for number, fields in zip(chunk, result):
+                self._set(number, fields)
+                self._rows[number] = 1
+            self._dirty = True
+            yield chunk[-1] + 1
+
+
+def _fields(mailbox, number):
+    """Return the column fields of message number of mailbox"""
+    get_headers = getattr(mailbox, 'get_headers', mailbox.__getitem__)
+    try:
+        message = get_headers(number)
+    except KeyError:
+        return NODATE, 0, '', '', 0, 0  # Removed since opened
+
+    date, offset = NODATE, 0
+    if message['date'] is not None:
+        parsed = email.utils.parsedate_tz(message['date'])
+        try:
+            date = email.utils.mktime_tz(parsed)
+            offset = parsed[9] or 0
+        except (TypeError, ValueError, OverflowError):
+            pass  # Unparseable date
+
+    try:
+        size = mailbox.get_size(number)
+    except AttributeError:
+        size = 0
+
+    flags = 0
+    if message.get_content_maintype() == 'multipart':
+        flags |= FLAG_ATTACHMENT
+
+    return (date, offset,
+            utils.get_header_param(message, 'from').strip(),
+            utils.get_header_param(message, 'subject').strip(),
+            size, flags)
+
+
+def _parse_shard(task):
+    """Parse the headers of some messages of an mbox in a worker process"""
+    path, starts, stops = task
+    mailbox = mbox.Mbox(path, toc=(starts, stops))
+    try:
+        return [_fields(mailbox, n) for n in range(len(mailbox))]
+    finally:
+        mailbox.close()
+
+
+# =================================================================
+# Testing procedures.
+# Execute this module (python -m bluebird.store) to perform unit testing.
+# =================================================================
+
+if __name__ == '__main__':
+    import unittest
+    import email
+    import shutil
+    import tempfile
+
+    MESSAGE = ('Date: %s\n'
+               'From: "Sender" <sender@example.com>\n'
+               'Subject: message %d\n'
+               'Content-Type: %s\n'
+               '\n'
+               'Body\n')
+
+    class TestHeaderStore(unittest.TestCase):
+
+        def setUp(self):
+            self._mailbox = [
+                email.message_from_string(MESSAGE % (date, i, ctype))
+                for i, (date, ctype) in enumerate((
+                    ('Sat, 05 Jan 2013 23:30:00 -0100', 'text/plain'),
+                    ('Sun, 06 Jan 2013 00:30:00 +0100', 'multipart/mixed'),
+                    ('garbage', 'text/plain')))]
+
+        def test_columns(self):
+            hs = HeaderStore(self._mailbox)
+            hs.fill()
+            self.assertEqual(hs.subjects, ['message 0', 'message 1',
+                                           'message 2'])
+            self.assertEqual(hs.senders[0], '"Sender" <sender@example.com>')
+            self.assertEqual(list(hs.dates), [1357432200, 1357428600, NODATE])
+            self.assertEqual(list(hs.tzoffsets), [-3600, 3600, 0])
+            self.assertEqual(list(hs.flags), [0, FLAG_ATTACHMENT, 0])
+
+        def test_pages(self):
+            mailbox = self._mailbox * PAGESIZE
+            hs = HeaderStore(mailbox)
+            hs.load(2 * PAGESIZE + 1, 2 * PAGESIZE + 2)
+            self.assertEqual([hs.isloaded(n * PAGESIZE)
+                              for n in range(3)], [False, False, True])
+            self.assertEqual(hs.subjects[2 * PAGESIZE + 1],
+                             mailbox[2 * PAGESIZE + 1]['subject'])
+            self.assertEqual(hs.subjects[0], '')
+
+        def test_cache(self):
+            class Mailbox(list):
+                path = 'INBOX'
+
+            class CountingStore(HeaderStore):
+                parsed = []
+
+                def _parse(self, number):
+                    self.parsed.append(number)
+                    HeaderStore._parse(self, number)
+
+            cache.CACHEPATH = tempfile.mkdtemp()
+            try:
+                mailbox = Mailbox(self._mailbox)
+                mailbox.keys = [10, 11, 12]
+                CountingStore(mailbox).fill()
+                self.assertEqual(CountingStore.parsed, [0, 1, 2])
+
+                # Appended to
+                mailbox.append(self._mailbox[0])
+                mailbox.keys.append(13)
+                hs = CountingStore(mailbox)
+                hs.fill()
+                self.assertEqual(CountingStore.parsed[3:], [3])
+
+                # Compacted: 11 expunged, 14 is new
+                mailbox[:] = [self._mailbox[2], self._mailbox[0],
+                              self._mailbox[1]]
+                mailbox.keys = [12, 10, 14]
+                hs = CountingStore(mailbox)
+                self.assertFalse(hs.isloaded(0))  # Message 2 is missing
+                hs.fill()
+                self.assertEqual(CountingStore.parsed[4:], [2])
+                self.assertEqual(hs.subjects, ['message 2', 'message 0',
+                                               'message 1'])
+            finally:
+                shutil.rmtree(cache.CACHEPATH)
+
+        def test_summary(self):
+            class Mailbox(list):
+                summary = {1: (0, 9, 1357432200, mork.MSG_FLAG_ATTACHMENT,
+                               'Bob', 'Re: Lunch', 1)}
+
+                def get_size(self, number):
+                    return 100
+
+            hs = HeaderStore(Mailbox(self._mailbox))
+            self.assertTrue(hs._rows[1])
+            self.assertFalse(hs._rows[0])
+            hs.fill()
+            self.assertEqual(hs.subjects, ['message 0', 'Re: Lunch',
+                                           'message 2'])
+            self.assertEqual(hs.dates[1], 1357432200)
+            self.assertEqual(hs.sizes[1], 100)
+            self.assertEqual(list(hs.flags), [0, FLAG_ATTACHMENT, 0])
+
+        def test_summary_rows(self):
+            read = []
+
+            class Mailbox(list):
+                path = 'INBOX'
+
+                @property
+                def summary(self):
+                    read.append(len(self))
+
+            global SUMMARYROWS
+            summaryrows, SUMMARYROWS = SUMMARYROWS, 2
+            cache.CACHEPATH = tempfile.mkdtemp()
+            try:
+                mailbox = Mailbox(self._mailbox)
+                mailbox.keys = [10, 11, 12]
+                HeaderStore(mailbox).fill()
+                mailbox.append(self._mailbox[0])
+                mailbox.keys.append(13)
+                HeaderStore(mailbox)  # A single new message: not read
+                self.assertEqual(read, [3])
+            finally:
+                SUMMARYROWS = summaryrows
+                shutil.rmtree(cache.CACHEPATH)
+
+        def test_select(self):
+            hs = HeaderStore(self._mailbox)
+            self.assertEqual(hs.select(hs.subjects, 'message 1'), [1])
+            # Days are those of the sender's timezone
+            jan5 = 1357344000
+            self.assertEqual(hs.select_dates(jan5, jan5 + 86400), [0])
+            self.assertEqual(hs.select_dates(jan5, jan5 + 2 * 86400), [0, 1])
+            self.assertEqual(hs.select_dates(jan5, jan5 + 2 * 86400, 1),
+                             [1])
+
+        def test_dateindex(self):
+            mailbox = self._mailbox[::-1] * 2  # Newest first, then not
+            hs = HeaderStore(mailbox)
+            jan5 = 1357344000
+            self.assertEqual(hs.select_dates(jan5, jan5 + 86400), [2, 5])
+            self.assertEqual(hs.select_dates(jan5, jan5 + 2 * 86400),
+                             [1, 2, 4, 5])
+            self.assertEqual(hs.select_dates(NODATE, jan5), [0, 3])
+            self.assertTrue(hs.isfilled())
+
+            hs._set(0, (jan5, 0, '', '', 0, 0))  # Reindexed
+            self.assertEqual(hs.select_dates(jan5, jan5 + 86400), [0, 2, 5])
+
+        def test_ifill(self):
+            hs = HeaderStore(self._mailbox)
+            progress = list(hs.ifill())
+            self.assertEqual(progress[-1], len(self._mailbox))
+            self.assertEqual(progress, sorted(progress))
+            self.assertTrue(hs.isloaded(len(self._mailbox) - 1))
+
+    unittest.main()
@@ -0,0 +1,501 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Mailbox full text index
+
+A search matches the messages whose from, subject or body contain the
+pattern. A message can only contain the pattern if it contains every
+three character substring (trigram) of the pattern, so an index of the
+trigrams of each message narrows a search down to a few candidates,
+which are then checked as usual.
+
+Trigrams are indexed in lower case: the candidates are a superset of
+the matches whatever the case rules of the search.
+
+The posting list of each trigram is the ascending list of the numbers
+of the messages containing it, stored as variable length deltas (about
+one byte per entry).
+
+Mailboxes searched too rarely to be worth a full index get a block
+filter instead: a bloom filter of the trigrams of each block of
+messages, a few bits per distinct trigram. It is built from the raw
+bytes of the mbox; only the messages whose text is encoded (see
+search.prefilter) are parsed. A search skips the blocks whose filter
+lacks a trigram of the pattern. Trigrams never span words there: a
+pattern found in a message has each of its words inside a word of the
+message.
+
+classes:
+
+TrigramIndex -- Persistent trigram index of a mailbox
+BlockFilter -- Persistent bloom filters of the blocks of a mailbox
+
+"""
+import re
+import bisect
+import zlib
+import threading
+
+from . import cache
+from . import search
+from . import utils
+
+### Module Constants ##
+
+# Bump when the layout of the index changes
+INDEXVERSION = 1
+
+# Stop intersecting posting lists when this few candidates are left;
+# checking them is cheaper than decoding more lists.
+CANDIDATES = 32
+
+# Bump when the layout of the block filters changes
+FILTERVERSION = 1
+
+BLOCKSIZE = 256  # Messages in a block filter
+BLOOMBITS = 10  # Filter bits per distinct trigram of a block
+BLOOMHASHES = 7  # Bits set per trigram: about 1% of false positives
+
+_WORD = re.compile(br'\w{3,}')  # ASCII words long enough for a trigram
+
+
+# =================================================================
+
+
+class TrigramIndex(object):
+    """Persistent trigram index of a mailbox
+
+    The index covers the first messages of the mailbox. Mail appended
+    later is indexed by update(); if the mailbox was rewritten (e.g. by a
+    compaction) the index starts over. Mailboxes without path and keys
+    attributes (see mbox.Mbox) are indexed in memory only.
+
+    """
+
+    _mailbox = None
+    _path = None
+    _keys = None  # Keys of the messages indexed, None until loaded
+    _postings = None
+    _last = None  # Last message number in each posting list
+
+    def __init__(self, mailbox):
+        self._mailbox = mailbox
+        try:
+            self._path = cache.sidecar_path(mailbox.path, 'tri')
+        except AttributeError:
+            self._path = None
+
+    def __len__(self):
+        """Number of messages indexed"""
+        self._load()
+        return len(self._keys)
+
+    def _load(self):
+        """Read the stored index the first time it is needed"""
+        if self._keys is not None:
+            return
+
+        self._keys, self._postings, self._last = [], {}, {}
+        if self._path is None:
+            return
+
+        data = cache.load(self._path)
+        keys = self._mailbox.keys
+        if (data is not None and data['version'] == INDEXVERSION and
+                data['keys'] == keys[:len(data['keys'])]):
+            self._keys = data['keys']
+            self._postings = data['postings']
+            self._last = data['last']
+
+    def isbuilt(self):
+        """I.isbuilt() -> Bool
+
+        Return True if the index was built for the mailbox.
+        """
+        return len(self) > 0 or len(self._mailbox) == 0
+
+    def update(self):
+        """I.update() -> void
+
+        Index the messages not indexed yet and store the index.
+        """
+        count = len(self._mailbox)
+        if len(self) == count:
+            return
+
+        keys = getattr(self._mailbox, 'keys', range(count))
+        for n in range(len(self), count):
+            try:
+                message = self._mailbox[n]
+            except KeyError:
+                continue  # Removed since opened, see maildir.Maildir
+            self._add(n, message)
+        self._keys = keys[:count]
+
+        if self._path is not None:
+            cache.dump(self._path,
+                       {'version': INDEXVERSION,
+                        'keys': self._keys,
+                        'postings': self._postings,
+                        'last': self._last})
+
+    def candidates(self, pattern):
+        """I.candidates(pattern) -> list or None
+
+        Return the ascending numbers of the indexed messages that may
+        contain pattern. None if the pattern is too short to use the
+        index: every message is a candidate.
+        """
+        grams = trigrams(pattern.lower())
+        if not grams:
+            return None
+
+        self._load()
+        postings = []
+        for gram in grams:
+            if gram not in self._postings:
+                return []
+            postings.append(self._postings[gram])
+        postings.sort(key=len)
+
+        result = set(_decode(postings[0]))
+        for posting in postings[1:]:
+            if len(result) <= CANDIDATES:
+                break
+            result.intersection_update(_decode(posting))
+        return sorted(result)
+
+    def _add(self, number, message):
+        """Add the trigrams of message to the posting lists"""
+        grams = set()
+        for text in (utils.get_header_param(message, 'from'),
+                     utils.get_header_param(message, 'subject'),
+                     utils.get_content_body(message)):
+            if isinstance(text, bytes):
+                text = text.decode('utf-8', 'replace')  # Python 2
+            grams.update(trigrams(text.lower()))
+
+        for gram in grams:
+            posting = self._postings.get(gram)
+            if posting is None:
+                posting = self._postings[gram] = bytearray()
+            _encode(number - self._last.get(gram, -1), posting)
+            self._last[gram] = number
+
+
+class BlockFilter(object):
+    """Persistent bloom filters of the blocks of a mailbox
+
+    Like TrigramIndex, the filters cover the first messages of the
+    mailbox and update() extends them to appended mail. Only mailboxes
+    with raw access (see mbox.Mbox) are filtered; ranges() answers None
+    for the others.
+
+    """
+
+    _mailbox = None
+    _path = None
+    _keys = None  # Keys of the messages filtered, None until loaded
+    _filters = None  # Bloom filter of each block
+    _lock = None
+    _thread = None  # Background update, see start_update()
+
+    def __init__(self, mailbox):
+        self._mailbox = mailbox
+        self._lock = threading.Lock()
+        try:
+            self._path = cache.sidecar_path(mailbox.path, 'blk')
+            mailbox.data, mailbox.toc, mailbox.keys
+        except AttributeError:
+            self._path = None
+
+    def __len__(self):
+        """Number of messages filtered"""
+        self._load()
+        return len(self._keys)
+
+    def _load(self):
+        """Read the stored filters the first time they are needed"""
+        if self._keys is not None:
+            return
+
+        self._keys, self._filters = [], []
+        if self._path is None:
+            return
+
+        data = cache.load(self._path)
+        keys = self._mailbox.keys
+        if (data is not None and data['version'] == FILTERVERSION and
+                data['keys'] == keys[:len(data['keys'])]):
+            self._keys = data['keys']
+            self._filters = data['filters']
+
+    def update(self):
+        """F.update() -> void
+
+        Filter the messages not filtered yet and store the filters.
+        """
+        if self._path is None:
+            return
+
+        with self._lock:
+            count = len(self._mailbox)
+            if len(self) == count:
+                return
+
+            # A partial last block is built again with the new mail
+            del self._filters[len(self._keys) // BLOCKSIZE:]
+            for first in range(len(self._filters) * BLOCKSIZE, count,
+                               BLOCKSIZE):
+                self._filters.append(
+                    self._block(first, min(first + BLOCKSIZE, count)))
+            self._keys = self._mailbox.keys[:count]
+
+            cache.dump(self._path, {'version': FILTERVERSION,
+                                    'keys': self._keys,
+                                    'filters': self._filters})
+
+    def start_update(self):
+        """F.start_update() -> void
+
+        Like update(), in a background thread that nobody waits for, so
+        that building the filters never delays a search or stopping it.
+        Does nothing while a previous update is running.
+        """
+        if self._path is None:
+            return
+        if self._thread is not None and self._thread.is_alive():
+            return
+
+        self._thread = threading.Thread(target=self._background_update)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _background_update(self):
+        """update() in the background thread"""
+        try:
+            self.update()
+        except (ValueError, IOError, OSError):
+            pass  # Mailbox closed meanwhile: try again next time
+
+    def ranges(self, pattern):
+        """F.ranges(pattern) -> list or None
+
+        Return the ascending (first, last) ranges of messages that may
+        contain pattern; the messages not filtered yet always may. None if
+        the pattern has no word long enough to use the filters.
+        """
+        hashes = [_hashes(gram)
+                  for gram in _wordgrams(pattern.encode('utf-8').lower())]
+        if not hashes or self._path is None:
+            return None
+
+        self._load()
+        result = []
+        count = len(self._mailbox)
+        for i, bloom in enumerate(self._filters):
+            bloom = bytearray(bloom)
+            size = 8 * len(bloom)
+            if all(all(bloom[p >> 3] >> (p & 7) & 1
+                       for p in _positions(h1, h2, size))
+                   for h1, h2 in hashes):
+                _extend(result, i * BLOCKSIZE,
+                        min((i + 1) * BLOCKSIZE, len(self._keys)))
+        if len(self._keys) < count:
+            _extend(result, len(self._keys), count)
+        return result
+
+    def _block(self, first, last):
+        """Bloom filter of the messages from first to last - 1"""
+        starts, stops = self._mailbox.toc
+        raw = self._mailbox.data[starts[first]:stops[last - 1]]
+        grams = _wordgrams(raw.lower())
+
+        # Encoded messages: the trigrams of their decoded text too
+        opaque = set()
+        for match in search.OPAQUECHARSET.finditer(raw):
+            pos = starts[first] + match.start()
+            opaque.add(bisect.bisect_right(starts, pos, first, last) - 1)
+        for n in sorted(opaque):
+            message = self._mailbox[n]
+            for text in (utils.get_header_param(message, 'from'),
+                         utils.get_header_param(message, 'subject'),
+                         utils.get_content_body(message)):
+                if not isinstance(text, bytes):
+                    text = text.encode('utf-8', 'replace')
+                grams.update(_wordgrams(text.lower()))
+
+        size = max(8, BLOOMBITS * len(grams))
+        bloom = bytearray((size + 7) // 8)
+        size = 8 * len(bloom)
+        for gram in grams:
+            h1, h2 = _hashes(gram)
+            for p in _positions(h1, h2, size):
+                bloom[p >> 3] |= 1 << (p & 7)
+        return bytes(bloom)
+
+
+# =================================================================
+
+
+def trigrams(text):
+    """Return the set of three character substrings of text"""
+    return set(text[i:i + 3] for i in range(len(text) - 2))
+
+
+def _wordgrams(data):
+    """Return the set of trigrams of the ASCII words of bytes data"""
+    grams = set()
+    for word in set(_WORD.findall(data)):
+        grams.update(word[i:i + 3] for i in range(len(word) - 2))
+    return grams
+
+
+def _hashes(gram):
+    """Two independent hashes of a trigram"""
+    return (zlib.crc32(gram) & 0xffffffff,
+            zlib.crc32(gram, 0x5bd1e995) & 0xffffffff | 1)
+
+
+def _positions(h1, h2, size):
+    """Bits of a bloom filter of size bits set for a trigram"""
+    return [(h1 + i * h2) % size for i in range(BLOOMHASHES)]
+
+
+def _extend(ranges, first, last):
+    """Append range first, last to ranges, merging it with the last one"""
+    if ranges and ranges[-1][1] == first:
+        ranges[-1] = (ranges[-1][0], last)
+    else:
+        ranges.append((first, last))
+
+
+def _encode(value, data):
+    """Append positive integer value to bytearray data as a varint"""
+    while value > 0x7f:
+        data.append(0x80 | (value & 0x7f))
+        value >>= 7
+    data.append(value)
+
+
+def _decode(data):
+    """Return the list of numbers in a posting list"""
+    numbers = []
+    number, value, shift = -1, 0, 0
+    for byte in bytearray(data):
+        value |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            number += value
+            numbers.append(number)
+            value, shift = 0, 0
+    return numbers
+
+
+# =================================================================
+# Testing procedures.
+# Execute this module (python -m bluebird.textindex) to perform unit testing.
+# =================================================================
+
+if __name__ == '__main__':
+    import unittest
+    import email
+    import shutil
+    import tempfile
+
+    from . import mbox
+
+    MESSAGE = ('From: %s\n'
+               'Subject: %s\n'
+               '\n'
+               '%s\n')
+
+    class TestTrigramIndex(unittest.TestCase):
+
+        def setUp(self):
+            self._mailbox = [email.message_from_string(MESSAGE % fields)
+                             for fields in (
+                                 ('Alice', 'Invoice', 'Please pay'),
+                                 ('Bob', 'Lunch', 'See the invoice'),
+                                 ('Carol', 'Hello', 'Nothing here'))]
+
+        def test_posting(self):
+            data = bytearray()
+            for delta in (1, 127, 128, 300000):
+                _encode(delta, data)
+            self.assertEqual(_decode(data), [0, 127, 255, 300255])
+
+        def test_candidates(self):
+            index = TrigramIndex(self._mailbox)
+            self.assertFalse(index.isbuilt())
+            index.update()
+            self.assertTrue(index.isbuilt())
+            self.assertEqual(index.candidates('invoice'), [0, 1])
+            self.assertEqual(index.candidates('ALI'), [0])
+            self.assertEqual(index.candidates('e p'), [0])
+            self.assertEqual(index.candidates('zzz'), [])
+            self.assertIsNone(index.candidates('he'))
+
+            # Appended mail
+            self._mailbox.append(self._mailbox[0])
+            index.update()
+            self.assertEqual(index.candidates('invoice'), [0, 1, 3])
+
+    class TestBlockFilter(unittest.TestCase):
+
+        def setUp(self):
+            global BLOCKSIZE
+            self._blocksize, BLOCKSIZE = BLOCKSIZE, 2
+            self._dir = tempfile.mkdtemp()
+            cache.CACHEPATH = self._dir
+            self.write(('Please pay', 'See the invoice', 'Nothing here'))
+            self.write(('Subject: =?utf-8?q?hidden_word?=\n\nNone',), 'a')
+
+        def tearDown(self):
+            global BLOCKSIZE
+            BLOCKSIZE = self._blocksize
+            shutil.rmtree(self._dir)
+
+        def write(self, bodies, mode='w'):
+            with open(self._dir + '/INBOX', mode) as f:
+                for body in bodies:
+                    f.write('From - Sat Jan 01 00:00:00 2013\n'
+                            'From: Alice\n' + body + '\n\n')
+
+        def ranges(self, pattern):
+            mailbox = mbox.Mbox(self._dir + '/INBOX')
+            try:
+                blocks = BlockFilter(mailbox)
+                blocks.update()
+                return blocks.ranges(pattern)
+            finally:
+                mailbox.close()
+
+        def test_ranges(self):
+            self.assertEqual(self.ranges('Invoice'), [(0, 2)])
+            self.assertEqual(self.ranges('Nothing'), [(2, 4)])
+            self.assertEqual(self.ranges('HIDDEN'), [(2, 4)])  # Decoded
+            self.assertEqual(self.ranges('alice'), [(0, 4)])
+            self.assertEqual(self.ranges('zzz'), [])
+            self.assertIsNone(self.ranges('he'))
+
+            # Appended mail
+            self.write(('The invoice again',), 'a')
+            self.assertEqual(self.ranges('invoice'), [(0, 2), (4, 5)])
+
+        def test_background(self):
+            mailbox = mbox.Mbox(self._dir + '/INBOX')
+            blocks = BlockFilter(mailbox)
+            blocks.start_update()
+            blocks._thread.join()
+            self.assertEqual(len(blocks), 4)
+
+            # Closed mailbox: the update gives up quietly
+            self.write(('The invoice again',), 'a')
+            mailbox.close()
+            blocks = BlockFilter(mbox.Mbox(self._dir + '/INBOX'))
+            blocks._mailbox.close()
+            blocks.start_update()
+            blocks._thread.join()
+
+    unittest.main()
@@ -14,10 +14,13 @@ from __future__ import print_function
 import os
 import os.path
 import sys
-import mailbox
 
 from . import profileparser
 from . import prefparser
+from . import mbox
+from . import maildir
+from . import gloda
+from . import folders
 
 # __ALL__: List of public objects. Overrides the import default behaviour.
 #__ALL__ = ['ThunderReader']
@@ -67,8 +70,13 @@ def get_profile(name='default'):
     return None
 
 
-def get_mail_directories(profile):
-    """Returns a list of mail directories for the given profile"""
+def get_mail_directories(profile, recursive=True):
+    """Returns a list of mail directories for the given profile
+
+    If recursive is False, the subdirectories of the mail directories
+    are left out.
+
+    """
     if not isinstance(profile, profileparser.Profile):
         raise AttributeError
 
@@ -82,34 +90,26 @@ def get_mail_directories(profile):
               file=sys.stderr)
         exit(1)
 
-    return [d for d in pparser.get_directories()]
+    return [d for d in pparser.get_directories(recursive)]
 
 
 def is_mailbox(path):
-    """ Returns True if the path points to a mailbox mbox file
-        False otherwise.
+    """ Returns True if the path points to a mailbox mbox file or
+        maildir folder, False otherwise.
     """
-    #f = open('a.out', 'a')
     if os.path.isdir(path):
-        #f.write(path + '\tFalse: Dir\n'); f.close()
-        return False
+        return maildir.is_maildir(path)
 
-    dirname = os.path.dirname(path)
-    basename = os.path.basename(path)
+    return folders.is_mbox(path)
 
-    if '.' in basename:
-        #f.write(path + '\tFalse: Dot\n'); f.close()
-        return False
 
-    with open(path) as g:
-        if g.read(5) != 'From ':
-            #f.write(path + '\tFalse: From\n'); f.close()
-            return False
-
-    #f.write(path + '\tTrue\n'); f.close()
-    return True
-    #if '.' not in filename: return True
-    #else: return False
+def _open_mailbox(path):
+    """Mailbox in path: mbox file or maildir folder, empty if none"""
+    if path is None or not os.path.exists(path):
+        return []
+    elif os.path.isdir(path):
+        return maildir.Maildir(path)
+    return mbox.Mbox(path)
 
 
 # =================================================================
@@ -124,6 +124,7 @@ class ThunderReader(object):
     _mbpaths = None
     _crnt_mbpath = None
     _mailbox = None
+    _gloda = None  # Global search database of the profile, if any
 
     def __init__(self, profilename='default'):
         self._profile = get_profile()  # Default profile: default
@@ -148,6 +149,7 @@ class ThunderReader(object):
     @profile.setter
     def profile(self, profile):
         self._profile = profile
+        self._gloda = None
         self._mbpaths = self._get_mbpaths()  # get mailboxes paths
         self._crnt_mbpath = self._get_inbox_path()
         self._open_mailbox(self._crnt_mbpath)
@@ -156,6 +158,30 @@ class ThunderReader(object):
     def mailbox(self):
         return self._mailbox
 
+    @property
+    def gloda(self):
+        """Global search database of the profile (see gloda.GlodaIndex),
+        None if Thunderbird has not built one"""
+        if self._gloda is None and self._profile is not None:
+            path = os.path.join(THUNDERBIRDPATH, self._profile.path,
+                                gloda.GLODAFILE)
+            if os.path.exists(path):
+                self._gloda = gloda.GlodaIndex(path)
+        return self._gloda
+
+    def search_profile(self, pattern):
+        """T.search_profile(pattern) -> (list, list)
+
+        Search all the mailboxes of the profile with the global search
+        database: return the (path, number) of the messages found with
+        the full-text query pattern, and the paths of the mailboxes it
+        can not answer for (see gloda.GlodaIndex.search_folders).
+        """
+        if self.gloda is None:
+            return [], list(self._mbpaths)
+        return self.gloda.search_folders(self._mbpaths, pattern,
+                                         _open_mailbox)
+
     @property
     def mbpath(self):
         return self._crnt_mbpath
@@ -174,18 +200,24 @@ class ThunderReader(object):
 
     def _open_mailbox(self, path):
         """Set the mailbox in path and s the current mailbox"""
-        if path is None or not os.path.exists(path):
-            self._mailbox = []
-        else:
-            self._mailbox = mailbox.mbox(path, create=False)
+        if isinstance(self._mailbox, (mbox.Mbox, maildir.Maildir)):
+            self._mailbox.close()
+
+        self._mailbox = _open_mailbox(path)
 
     def _get_mbpaths(self):
-        """Searches and returns the path for all mailboxes"""
+        """Searches and returns the path for all mailboxes
+
+        Only the directories changed since the last start are listed
+        again (see folders.FolderCache).
+
+        """
+        found = folders.FolderCache(os.path.join(THUNDERBIRDPATH,
+                                                 self.profile.path))
         mbpaths = []
-        for d in get_mail_directories(self.profile):
-            mbpaths += [d + '/' + filename
-                        for filename in os.listdir(d)
-                        if is_mailbox(d + '/' + filename)]
+        for d in get_mail_directories(self.profile, recursive=False):
+            mbpaths += found.scan(d)
+        found.save()
 
         return mbpaths
 
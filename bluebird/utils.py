@@ -6,6 +6,9 @@ import email.header
 
 def get_header_param(message, name):
     """Get field name from a message header"""
+    if message[name] is None:
+        return ''  # Missing header
+
     if sys.version_info.major == 3:
         return get_header_param3(message, name)
     else:
@@ -8,6 +8,10 @@ from . import adapter
 from . import thunder
 from . import utils
 
+### Module Constants ##
+
+IDLETIME = 150  # ms without keys before an edit calls back
+
 
 class View(object):
     """Base class for view objects"""
@@ -87,20 +91,42 @@ class EditTextView(TextView):
     def __init__(self, window, text=''):
         super(EditTextView, self).__init__(window)
 
-    def edit(self, message=''):
-        """Displays an editable message"""
+    def edit(self, message='', onchange=None, onidle=None):
+        """Displays an editable message
+
+        If callbacks are given, keys are read with a timeout of IDLETIME
+        ms. When it runs out, onchange(text) is called if the text changed
+        since the last time, then onidle(). Keys typed in a burst only
+        trigger one onchange call.
+        """
         curses.curs_set(1)  # Show cursor
         origtext = self.text
         self.text = message
         x = len(message)
+        changed = False
+        if onchange is not None or onidle is not None:
+            self.window.timeout(IDLETIME)
         self.draw()
         while True:
             ch = self.window.getch()
-            if ch in (27, curses.ascii.ESC):
+            if ch == -1:  # Idle
+                if changed and onchange is not None:
+                    onchange(self.text)
+                changed = False
+                if onidle is not None:
+                    onidle()
+                self.draw()
+                try:
+                    self.window.move(0, x)
+                except curses.error:
+                    pass
+                continue
+            elif ch in (27, curses.ascii.ESC):
                 # Key: curses.ascii.ESC works
                 # Key: integer 27 is keycode generated by Escape key press
                 self.text = origtext
                 curses.curs_set(0)  # Hide cursor
+                self.window.timeout(-1)
                 self.draw()
                 return None
             elif ch == 10:
@@ -110,6 +136,7 @@ class EditTextView(TextView):
                 message = self.text
                 self.text = origtext
                 curses.curs_set(0)  # Hide cursor
+                self.window.timeout(-1)
                 self.draw()
                 return message
             elif ch == curses.ascii.DEL:
@@ -120,14 +147,17 @@ class EditTextView(TextView):
                 if x > 0:
                     self.text = self.text[:-1]
                     x -= 1
+                    changed = True
                 else:
                     curses.flash()
             elif ch == curses.ascii.SP:
                 self.text += ' '
                 x += 1
-            elif chr(ch).isalnum() or chr(ch) in '/()-_.':
+                changed = True
+            elif chr(ch).isalnum() or chr(ch) in '/()-_.:"<>':
                 self.text += chr(ch)
                 x += 1
+                changed = True
 
             self.draw()
             try: